@@ -1,12 +1,17 @@
 import os, sys
 import pickle
 import numpy as np
+from scipy.linalg import block_diag
+
+# XLA auto-clustering of the remaining TF ops; has to be set before
+# tensorflow is imported
+os.environ.setdefault("TF_XLA_FLAGS", "--tf_xla_auto_jit=2")
 import tensorflow as tf
 
 from provabgs import infer as Infer
 
 from speculator import SpectrumPCA
-from speculator import Speculator
+from speculator import SpectrumSpeculator
 
 # -------------------------------------------------------
 # params
@@ -14,12 +19,17 @@ from speculator import Speculator
 version = "lrg.0.1"
 model = sys.argv[1]
 nbatch = int(sys.argv[2])
-i_wave = int(sys.argv[3])
+i_wave = sys.argv[3]  # index of the wavelength bin or 'all' to train all bins jointly
 n_pcas = int(sys.argv[4])
 Nlayer = int(sys.argv[5])
 Nunits = int(sys.argv[6])
 b_size = int(sys.argv[7])
+# optional: 'fp32' to train in full precision (e.g. as a baseline for the
+# mixed precision validation loss)
+precision = sys.argv[8] if len(sys.argv) > 8 else "mixed"
 desc = "nbatch%i" % b_size
+if precision == "fp32":
+    desc += ".fp32"
 # -------------------------------------------------------
 assert os.environ["NERSC_HOST"] == "perlmutter"
 
@@ -27,21 +37,25 @@ assert os.environ["NERSC_HOST"] == "perlmutter"
 dat_dir = "/pscratch/sd/b/bid13/provabgs/emulator/lrg/"
 wave = np.load(os.path.join(dat_dir, "wave.%s.npy" % model))
 
-# wavelength bins
-wave_bin = [
-    (wave >= 1000) & (wave < 2000),
-    (wave >= 2000) & (wave < 3600),
-    (wave >= 3600) & (wave < 5500),
-    (wave >= 5500) & (wave < 7410),
-    (wave >= 7410) & (wave < 60000),
-][i_wave]
+# wavelength bins: wave is sorted so each bin is a contiguous slice. With
+# i_wave = 'all' a single network is trained on the PCA coefficients of all
+# bins, which share the same input parameters
+wave_edges = np.array([1000, 2000, 3600, 5500, 7410, 60000])
+if i_wave == "all":
+    i_waves = list(range(len(wave_edges) - 1))
+    str_wbin = ".w%i_%i" % (wave_edges[0], wave_edges[-1])
+else:
+    i_waves = [int(i_wave)]
+    str_wbin = ".w%i_%i" % (wave_edges[i_waves[0]], wave_edges[i_waves[0] + 1])
 
-str_wbin = [".w1000_2000", ".w2000_3600", ".w3600_5500", ".w5500_7410", ".w7410_60000"][
-    i_wave
-]
+wave_bins = []
+for iw in i_waves:
+    i_lo, i_hi = np.searchsorted(wave, wave_edges[iw : iw + 2])
+    wave_bins.append(slice(i_lo, i_hi))
+# the bins are adjacent so together they are also a contiguous slice
+wave_bin = slice(wave_bins[0].start, wave_bins[-1].stop)
 
 n_hidden = [Nunits for i in range(Nlayer)]
-n_wave = np.sum(wave_bin)
 
 # -------------------------------------------------------
 if model == "nmf":
@@ -54,25 +68,35 @@ else:
 # load trained PCA basis object
 print("loading PCA bases")
 
-fpca = os.path.join(
-    dat_dir,
-    "fsps.%s.v%s.seed0_%i%s.pca%i.hdf5"
-    % (model, version, nbatch - 1, str_wbin, n_pcas),
-)
-PCABasis = SpectrumPCA(
-    n_parameters=n_param,  # number of parameters
-    n_wavelengths=n_wave,  # number of wavelength values
-    n_pcas=n_pcas,  # number of pca coefficients to include in the basis
-    spectrum_filenames=None,  # list of filenames containing the (un-normalized) log spectra for training the PCA
-    parameter_filenames=[],  # list of filenames containing the corresponding parameter values
-    parameter_selection=None,
-)  # pass an optional function that takes in parameter vector(s) and returns True/False for any extra parameter cuts we want to impose on the training sample (eg we may want to restrict the parameter ranges)
-PCABasis._load_from_file(fpca)
+fpcas, PCABases = [], []
+for iw, wbin in zip(i_waves, wave_bins):
+    fpca = os.path.join(
+        dat_dir,
+        "fsps.%s.v%s.seed0_%i.w%i_%i.pca%i.hdf5"
+        % (model, version, nbatch - 1, wave_edges[iw], wave_edges[iw + 1], n_pcas),
+    )
+    PCABasis = SpectrumPCA(
+        n_parameters=n_param,  # number of parameters
+        n_wavelengths=wbin.stop - wbin.start,  # number of wavelength values
+        n_pcas=n_pcas,  # number of pca coefficients to include in the basis
+        spectrum_filenames=None,  # list of filenames containing the (un-normalized) log spectra for training the PCA
+        parameter_filenames=[],  # list of filenames containing the corresponding parameter values
+        parameter_selection=None,
+    )  # pass an optional function that takes in parameter vector(s) and returns True/False for any extra parameter cuts we want to impose on the training sample (eg we may want to restrict the parameter ranges)
+    PCABasis._load_from_file(fpca)
+
+    fpcas.append(fpca)
+    PCABases.append(PCABasis)
+fpca = fpcas[0]
 
 # -------------------------------------------------------
 # training theta and pca
-_thetas = np.load(fpca.replace(".hdf5", "_parameters.npy"))
-_pcas = np.load(fpca.replace(".hdf5", "_pca.npy"))
+# memory-mapped so that the full arrays are never copied into host memory;
+# only the copies uploaded below are materialized. The parameters are the
+# same for all wavelength bins.
+_thetas = np.load(fpca.replace(".hdf5", "_parameters.npy"), mmap_mode="r")
+_pcas_bins = [np.load(f.replace(".hdf5", "_pca.npy"), mmap_mode="r") for f in fpcas]
+assert all(_p.shape[0] == _thetas.shape[0] for _p in _pcas_bins)
 
 if model == "nmf":
     _thetas = _thetas[:, 1:]
@@ -83,44 +107,123 @@ if model == "nmf":
 #    _thetas[:,1] = np.log10(_thetas[:,1])
 
 # get parameter shift and scale
-theta_shift = tf.convert_to_tensor(np.mean(_thetas, axis=0).astype(np.float32))
-theta_scale = tf.convert_to_tensor(np.std(_thetas, axis=0).astype(np.float32))
+# (cached next to the PCA file so restarts do not recompute them)
+fstats = fpca.replace(".hdf5", "_stats.npz")
+if os.path.isfile(fstats):
+    with np.load(fstats) as _stats:
+        _shift, _scale = _stats["shift"], _stats["scale"]
+else:
+    _shift = _thetas.mean(0, dtype=np.float32)
+    _scale = _thetas.std(0, dtype=np.float32)
+    np.savez(fstats, shift=_shift, scale=_scale)
+theta_shift = tf.convert_to_tensor(_shift)
+theta_scale = tf.convert_to_tensor(_scale)
 
 Ntrain = int(0.9 * _thetas.shape[0])
 Nvalid = _thetas.shape[0] - Ntrain
 print("Ntrain = %i, Nvalid = %i" % (Ntrain, Nvalid))
 
-theta_train = tf.convert_to_tensor(_thetas[:Ntrain, :].astype(np.float32))
-pca_train = tf.convert_to_tensor(_pcas[:Ntrain, :].astype(np.float32))
+# with mixed precision the training and validation sets are stored in float16
+# to halve their memory footprint; the fp32 baseline keeps them in float32 so
+# that it is not trained on quantized data. They are cast to float32 in the
+# training and validation steps. theta is normalized (theta_shift,
+# theta_scale) once here in float32 rather than in every forward pass; the
+# loss is evaluated in float32 inside Speculator
+data_dtype = np.float16 if precision == "mixed" else np.float32
+theta_train = tf.convert_to_tensor(((_thetas[:Ntrain, :] - _shift) / _scale).astype(data_dtype))
+pca_train = tf.convert_to_tensor(
+    np.concatenate([_p[:Ntrain, :] for _p in _pcas_bins], axis=1).astype(data_dtype)
+)
 
 # validation theta and pca
-theta_valid = tf.convert_to_tensor(_thetas[Ntrain:, :].astype(np.float32))
-pca_valid = tf.convert_to_tensor(_pcas[Ntrain:, :].astype(np.float32))
+theta_valid = tf.convert_to_tensor(((_thetas[Ntrain:, :] - _shift) / _scale).astype(data_dtype))
+pca_valid = tf.convert_to_tensor(
+    np.concatenate([_p[Ntrain:, :] for _p in _pcas_bins], axis=1).astype(data_dtype)
+)
 
 # -------------------------------------------------------
 # train Speculator
-speculator = Speculator(
+if precision == "mixed":
+    # mixed precision: hidden layers are evaluated in float16 (tensor cores)
+    # while the weights and the output layer are kept in float32. Dynamic loss
+    # scaling keeps the small gradients of the PCA-tail coefficients from
+    # underflowing in float16
+    tf.keras.mixed_precision.set_global_policy("mixed_float16")
+    optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
+        tf.keras.optimizers.Adam(),
+        dynamic=True,
+        initial_scale=2**15,
+        dynamic_growth_steps=2000,
+    )
+elif precision == "fp32":
+    optimizer = tf.keras.optimizers.Adam()
+else:
+    raise ValueError
+
+speculator = SpectrumSpeculator(
     n_parameters=n_param,  # number of model parameters
     wavelengths=wave[wave_bin],  # array of wavelengths
-    pca_transform_matrix=PCABasis.pca_transform_matrix,
+    # block diagonal over the wavelength bins
+    pca_transform_matrix=block_diag(*[_pb.pca_transform_matrix for _pb in PCABases]),
     parameters_shift=theta_shift,  # PCABasis.parameters_shift,
     parameters_scale=theta_scale,  # PCABasis.parameters_scale,
-    pca_shift=PCABasis.pca_shift,
-    pca_scale=PCABasis.pca_scale,
-    spectrum_shift=PCABasis.spectrum_shift,
-    spectrum_scale=PCABasis.spectrum_scale,
+    pca_shift=np.concatenate([_pb.pca_shift for _pb in PCABases]),
+    pca_scale=np.concatenate([_pb.pca_scale for _pb in PCABases]),
+    spectrum_shift=np.concatenate([_pb.spectrum_shift for _pb in PCABases]),
+    spectrum_scale=np.concatenate([_pb.spectrum_scale for _pb in PCABases]),
     n_hidden=n_hidden,  # network architecture (list of hidden units per layer)
     restore=False,
-    optimizer=tf.keras.optimizers.Adam(),
+    optimizer=optimizer,
 )  # optimizer for model training
 
+# theta_train and theta_valid are already normalized. theta_shift and
+# theta_scale are still stored in the saved emulator for inference
+speculator.normalize_parameters = False
+
+
+# XLA compiled training step (forward pass, gradients, and optimizer update)
+# and validation loss. batches have static shapes (drop_remainder=True) so
+# these are only traced once.
+@tf.function(jit_compile=True)
+def train_step(theta, pca):
+    theta, pca = tf.cast(theta, tf.float32), tf.cast(pca, tf.float32)
+    return speculator.training_step(theta, pca)
+
+
+@tf.function(jit_compile=True)
+def valid_step(theta, pca):
+    theta, pca = tf.cast(theta, tf.float32), tf.cast(pca, tf.float32)
+    # mean squared error of the batch
+    return tf.square(speculator.compute_loss(theta, pca))
+
+
+def valid_loss():
+    ''' validation loss evaluated over batches of the validation set to keep
+    the peak memory bounded. Batch mean squared errors are weighted by batch
+    size so this reproduces the loss over the full validation set.
+    '''
+    for theta, pca in validation_data:
+        valid_metric.update_state(
+            valid_step(theta, pca), sample_weight=tf.shape(theta)[0]
+        )
+    loss = np.sqrt(float(valid_metric.result()))
+    valid_metric.reset_state()
+    return loss
+
+
 # cooling schedule
 lr = [1e-3, 5e-4, 1e-4, 5e-5, 1e-5, 5e-6, 1e-6]
 batch_size = [b_size for _ in lr]
+steps_per_epoch = [tf.constant(Ntrain // b, dtype=tf.int32) for b in batch_size]
 gradient_accumulation_steps = [
     1 for _ in lr
 ]  # split the largest batch size into 10 when computing gradients to avoid memory overflow
 
+# learning rate as a variable, so changing it over the schedule does not
+# retrace the compiled training step
+lr_var = tf.Variable(lr[0], dtype=tf.float32, trainable=False)
+speculator.optimizer.learning_rate = lr_var
+
 # early stopping set up
 patience = 20
 
@@ -130,80 +233,129 @@ _floss = os.path.join(
     "%s.v%s.seed0_%i%s.pca%i.%ix%i.%s.loss.dat"
     % (model, version, nbatch - 1, str_wbin, n_pcas, Nlayer, Nunits, desc),
 )
-floss = open(_floss, "w")
-floss.close()
+floss = open(_floss, "w", buffering=1)  # line buffered; kept open for the run
 
-# train using cooling/heating schedule for lr/batch-size
-for i in range(len(lr)):
-    print("learning rate = " + str(lr[i]) + ", batch size = " + str(batch_size[i]))
+# running mean of the training and validation losses over an epoch
+train_metric = tf.keras.metrics.Mean()
+valid_metric = tf.keras.metrics.Mean()
 
-    # set learning rate
-    speculator.optimizer.lr = lr[i]
+# batched validation dataset
+validation_data = (
+    tf.data.Dataset.from_tensor_slices((theta_valid, pca_valid))
+    .batch(4096)
+    .prefetch(tf.data.AUTOTUNE)
+)
 
-    # create iterable dataset (given batch size)
-    training_data = (
-        tf.data.Dataset.from_tensor_slices((theta_train, pca_train))
-        .shuffle(theta_train.shape[0])
-        .batch(batch_size[i])
-    )
+# batch ordering does not need to be deterministic
+data_options = tf.data.Options()
+data_options.experimental_deterministic = False
+
+# training datasets keyed by batch size, so that they are only built once
+# for the whole learning rate schedule
+training_datasets = {}
+
+
+def get_training_data(b):
+    ''' iterable training dataset for batch size `b`. The shuffle buffer holds
+    100 batches rather than the full training set. Batches are prefetched
+    so that the host prepares the next batch while the GPU trains on the
+    current one; the last partial batch is dropped to keep shapes static.
+    '''
+    if b not in training_datasets:
+        training_datasets[b] = (
+            tf.data.Dataset.from_tensor_slices((theta_train, pca_train))
+            .shuffle(min(100 * b, theta_train.shape[0]), reshuffle_each_iteration=True)
+            .batch(b, drop_remainder=True)
+            .prefetch(tf.data.AUTOTUNE)
+            .with_options(data_options)
+        )
+    return training_datasets[b]
+
+
+@tf.function
+def run_epoch(iterator, steps):
+    ''' run an epoch of `steps` training steps in a single graph, so the
+    batch loop does not go back to python for every step
+    '''
+    for _ in tf.range(steps):
+        theta, pca = next(iterator)
+        train_metric.update_state(train_step(theta, pca))
+
+
+# trace the compiled training step before training, so tracing is not
+# billed to the first epoch
+train_step.get_concrete_function(*get_training_data(batch_size[0]).element_spec)
 
-    # set up training loss
-    training_loss = [np.infty]
-    validation_loss = [np.infty]
-    best_loss = np.infty
-    early_stopping_counter = 0
 
-    # loop over epochs
-    while early_stopping_counter < patience:
+try:
+    # train using cooling/heating schedule for lr/batch-size
+    for i in range(len(lr)):
+        print("learning rate = " + str(lr[i]) + ", batch size = " + str(batch_size[i]))
 
-        # loop over batches
-        train_loss, nb = 0, 0
-        for theta, pca in training_data:
-            # training step: check whether to accumulate gradients or not (only worth doing this for very large batch sizes)
+        # set learning rate
+        lr_var.assign(lr[i])
+
+        # iterable dataset (given batch size)
+        training_data = get_training_data(batch_size[i])
+
+        # set up early stopping
+        best_loss = np.inf
+        early_stopping_counter = 0
+
+        # loop over epochs
+        while early_stopping_counter < patience:
+
+            # loop over batches (the loss is averaged on device and only read
+            # out at the end of the epoch). check whether to accumulate gradients
+            # or not (only worth doing this for very large batch sizes)
             if gradient_accumulation_steps[i] == 1:
-                train_loss += speculator.training_step(theta, pca)
+                run_epoch(iter(training_data), steps_per_epoch[i])
             else:
-                train_loss += speculator.training_step_with_accumulated_gradients(
-                    theta, pca, accumulation_steps=gradient_accumulation_steps[i]
-                )
-            nb += 1
-        train_loss /= float(nb)
-        training_loss.append(train_loss)
+                for theta, pca in training_data:
+                    train_metric.update_state(
+                        speculator.training_step_with_accumulated_gradients(
+                            theta, pca, accumulation_steps=gradient_accumulation_steps[i]
+                        )
+                    )
+            train_loss = float(train_metric.result())
+            train_metric.reset_state()
 
-        # compute validation loss at the end of the epoch
-        validation_loss.append(speculator.compute_loss(theta_valid, pca_valid).numpy())
+            # compute validation loss at the end of the epoch
+            val_loss = valid_loss()
 
-        floss = open(_floss, "a")  # append
-        floss.write(
-            "%i \t %f \t %f \t %f\n"
-            % (batch_size[i], lr[i], train_loss, validation_loss[-1])
-        )
-        floss.close()
-
-        # early stopping condition
-        if validation_loss[-1] < best_loss:
-            best_loss = validation_loss[-1]
-            early_stopping_counter = 0
-        else:
-            early_stopping_counter += 1
-
-        if early_stopping_counter >= patience:
-            speculator.update_emulator_parameters()
-            speculator.save(
-                os.path.join(
-                    dat_dir,
-                    "%s.v%s.seed0_%i%s.pca%i.%ix%i.%s"
-                    % (
-                        model,
-                        version,
-                        nbatch - 1,
-                        str_wbin,
-                        n_pcas,
-                        Nlayer,
-                        Nunits,
-                        desc,
-                    ),
-                )
+            floss.write(
+                "%i \t %f \t %f \t %f\n"
+                % (batch_size[i], lr[i], train_loss, val_loss)
             )
-            print("Validation loss = %s" % str(best_loss))
 
+            # early stopping condition
+            if val_loss < best_loss:
+                best_loss = val_loss
+                early_stopping_counter = 0
+            else:
+                early_stopping_counter += 1
+
+            if early_stopping_counter >= patience:
+                speculator.update_emulator_parameters()
+                speculator.save(
+                    os.path.join(
+                        dat_dir,
+                        "%s.v%s.seed0_%i%s.pca%i.%ix%i.%s"
+                        % (
+                            model,
+                            version,
+                            nbatch - 1,
+                            str_wbin,
+                            n_pcas,
+                            Nlayer,
+                            Nunits,
+                            desc,
+                        ),
+                    )
+                )
+                print("Validation loss = %s" % str(best_loss))
+finally:
+    floss.close()
+
+# the training step should only be traced once for the entire schedule
+print("training step traced %i times" % train_step.experimental_get_tracing_count())
@@ -105,6 +105,10 @@ class Speculator(tf.keras.Model):
                 self.betas[i].assign(self.betas_[i])
 
         self.optimizer = optimizer
+
+        # set to False if the input parameters are already normalized (e.g.
+        # the training set is normalized once before training)
+        self.normalize_parameters = True
             
     # non-linear activation function
     def activation(self, x, alpha, beta):
@@ -115,18 +119,27 @@ class Speculator(tf.keras.Model):
     @tf.function
     def call(self, parameters):
         
+        # hidden layers are evaluated in the compute dtype of the model (float16
+        # under a mixed precision policy); the variables are kept in float32
+        cdtype = self.compute_dtype
+
+        # inputs may be stored at lower precision; normalize them in float32
+        parameters = tf.cast(parameters, dtype)
+        if self.normalize_parameters:
+            parameters = tf.divide(tf.subtract(parameters, self.parameters_shift), self.parameters_scale)
+
         outputs = []
-        layers = [tf.divide(tf.subtract(parameters, self.parameters_shift), self.parameters_scale)]
+        layers = [tf.cast(parameters, cdtype)]
         for i in range(self.n_layers - 1):
             
             # linear network operation
-            outputs.append(tf.add(tf.matmul(layers[-1], self.W[i]), self.b[i]))
+            outputs.append(tf.add(tf.matmul(layers[-1], tf.cast(self.W[i], cdtype)), tf.cast(self.b[i], cdtype)))
             
             # non-linear activation function
-            layers.append(self.activation(outputs[-1], self.alphas[i], self.betas[i]))
+            layers.append(self.activation(outputs[-1], tf.cast(self.alphas[i], cdtype), tf.cast(self.betas[i], cdtype)))
 
-        # linear output layer
-        layers.append(tf.add(tf.matmul(layers[-1], self.W[-1]), self.b[-1]))
+        # linear output layer (always float32 for numerical stability of the loss)
+        layers.append(tf.add(tf.matmul(tf.cast(layers[-1], dtype), self.W[-1]), self.b[-1]))
             
         # rescale the output (predicted PCA coefficients) and return
         return tf.add(tf.multiply(layers[-1], self.pca_scale), self.pca_shift)
@@ -222,6 +235,11 @@ class Speculator(tf.keras.Model):
 
     ### Infrastructure for network training ###
 
+    # loss: RMS difference between predicted and true PCA coefficients
+    def _loss(self, theta, pca):
+
+        return tf.sqrt(tf.reduce_mean(tf.math.squared_difference(self.call(theta), tf.cast(pca, dtype))))
+
     @tf.function
     def compute_loss(self, theta, pca):
         #print('--- pcas ---') 
@@ -229,7 +247,7 @@ class Speculator(tf.keras.Model):
         #    tf.print(self.call(theta)[i])
         #    tf.print(pca[i])
 
-        return tf.sqrt(tf.reduce_mean(tf.math.squared_difference(self.call(theta), pca)))      
+        return self._loss(theta, pca)
 
     @tf.function
     def compute_loss_and_gradients(self, theta, pca):
@@ -238,10 +256,18 @@ class Speculator(tf.keras.Model):
         with tf.GradientTape() as tape:
 
             # loss
-            loss = tf.sqrt(tf.reduce_mean(tf.math.squared_difference(self.call(theta), pca)))
+            loss = self._loss(theta, pca)
+
+            # scale the loss to avoid float16 gradient underflow (mixed precision)
+            if isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+                scaled_loss = self.optimizer.get_scaled_loss(loss)
+            else:
+                scaled_loss = loss
 
         # compute gradients
-        gradients = tape.gradient(loss, self.trainable_variables)
+        gradients = tape.gradient(scaled_loss, self.trainable_variables)
+        if isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
 
         return loss, gradients
 
@@ -281,6 +307,34 @@ class Speculator(tf.keras.Model):
         return accumulated_loss
 
 
+class SpectrumSpeculator(Speculator):
+    """
+    SPECULATOR model trained on the error of the reconstructed log spectrum
+    rather than on the error of the PCA coefficients
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        # super
+        super(SpectrumSpeculator, self).__init__(*args, **kwargs)
+
+        # copy of the pca transform matrix in the compute dtype (float16 under
+        # mixed precision) for the loss; the float32 matrix is the one saved
+        self.pca_transform_matrix_compute = tf.cast(self.pca_transform_matrix, self.compute_dtype)
+
+    # loss: RMS difference between predicted and true log spectra. The PCA
+    # coefficient residuals are projected onto the PCA basis with a single
+    # [batch x n_pcas] x [n_pcas x n_wavelengths] matmul in the compute dtype
+    # (the spectrum shift cancels in the difference)
+    def _loss(self, theta, pca):
+
+        residuals = tf.cast(tf.subtract(self.call(theta), tf.cast(pca, dtype)), self.compute_dtype)
+
+        spectrum_residuals = tf.cast(tf.matmul(residuals, self.pca_transform_matrix_compute), dtype)
+
+        return tf.sqrt(tf.reduce_mean(tf.square(tf.multiply(spectrum_residuals, self.spectrum_scale))))
+
+
 class SpectrumPCA():
     """
     SPECULATOR PCA compression class
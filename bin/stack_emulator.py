@@ -0,0 +1,14 @@
+"""
+
+script to convert the pickle files of the NMF and burst FSPS emulators into
+the .npz files of stacked parameters that `provabgs.models.NMF` reads. Only
+has to be run once; the pickle files are used if the .npz files are missing. 
+
+"""
+from provabgs import models as Models
+
+
+if __name__ == '__main__': 
+    for emu in ['nmf', 'burst']: 
+        fnpz = Models.NMF._write_emulator_npz(emu)
+        print('wrote %s' % fnpz)
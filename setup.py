@@ -67,7 +67,7 @@ if __name__ == "__main__":
         packages=PACKAGES,
         package_dir={"": "src"},
         include_package_data=True,
-        package_data={'provabgs': ['dat/*.pkl', 'dat/*.txt']},
+        package_data={'provabgs': ['dat/*.pkl', 'dat/*.npz', 'dat/*.txt']},
         install_requires=INSTALL_REQUIRES,
         classifiers=CLASSIFIERS,
         zip_safe=True,
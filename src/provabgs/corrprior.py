@@ -192,7 +192,7 @@ class CorrectPrior(object):
         if 'logmstar' in self.props: # log M*
             if debug: print('... calculating log M*') 
             tt = self.model._parse_theta(theta)
-            derived_props.append(tt['logmstar'])
+            derived_props.append(tt.logmstar)
 
         if 'avgsfr_1gyr' in self.props: # average SFR in the last 1 Gyr year
             assert 'logavgsfr_1gyr' not in self.props, "impossible to impose uniform priors on x and log(x) simultaneously..."
@@ -211,14 +211,14 @@ class CorrectPrior(object):
             if debug: print('... calculating avg sSFR_1Gyr') 
             tt = self.model._parse_theta(theta)
             avgsfr = self.model.avgSFR(theta, tage=self.tage, zred=self.zred, dt=1.)
-            derived_props.append(avgsfr/10**tt['logmstar'])
+            derived_props.append(avgsfr/10**tt.logmstar)
 
         if 'logavgssfr_1gyr' in self.props: # average log sSFR in the last 1 Gyr year
             assert 'avgssfr_1gyr' not in self.props, "impossible to impose uniform priors on x and log(x) simultaneously..."
             if debug: print('... calculating log avg sSFR_1Gyr') 
             tt = self.model._parse_theta(theta)
             avgsfr = self.model.avgSFR(theta, tage=self.tage, zred=self.zred, dt=1.)
-            derived_props.append(np.log10(avgsfr) - tt['logmstar'])
+            derived_props.append(np.log10(avgsfr) - tt.logmstar)
 
         if 'z_mw' in self.props: # mass-weighted metallicity 
             if debug: print('... calculating mass-weighted Z') 
@@ -11,6 +11,9 @@ import pickle
 import warnings
 import numpy as np 
 import scipy.interpolate as Interp
+from scipy.ndimage import convolve1d
+from scipy.signal import oaconvolve
+from collections import namedtuple, OrderedDict
 # --- astropy --- 
 from astropy import units as U
 from astropy.cosmology import Planck13
@@ -24,6 +27,17 @@ except ImportError:
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
 
+# stacked parameters of the wavelength bins of a PCA neural network emulator in
+# the order of the arguments of `UT.emu_forward`
+EmuParams = namedtuple('EmuParams', ['param_shift', 'param_scale', 'W_in',
+    'b_in', 'W_hid', 'b_hid', 'alphas', 'betas', 'W_out', 'b_out', 'pca_shift',
+    'pca_scale', 'pca_transform', 'spec_shift', 'spec_scale', 'wave_index'])
+
+# FSPS StellarPopulation objects shared by all models in the process (see
+# `NMF._ssp_initiate`) 
+_fsps_ssps = {} 
+
+
 class Model(object): 
     ''' Base class object for different SPS models. Different `Model` objects
     specify different SPS model. The primary purpose of the `Model` class is to
@@ -31,7 +45,15 @@ class Model(object):
     '''
     def __init__(self, cosmo=None, **kwargs): 
 
+        # caches for velocity dispersion: log-wavelength grids with their
+        # rebinning matrices (least recently used) and gaussian kernels 
+        self._vdisp_grids = OrderedDict() 
+        self._vdisp_kernels = {} 
+
         self._init_model(**kwargs)
+
+        # parsed parameter values (see `_parse_theta`) 
+        self._Theta = namedtuple('Theta', self._parameters)
         
         if cosmo is None: 
             self.cosmo = Planck13 # cosmology  
@@ -63,7 +85,15 @@ class Model(object):
             redshift of the SED 
 
         vdisp : float or array_like
-            velocity dispersion  
+            velocity dispersion. Either a single value or [Nsample] values 
+            for each sample. If any sample has vdisp > 0, all the samples are
+            put on the same log-wavelength grid and samples with vdisp <= 0
+            are not smoothed. Velocity dispersion is applied on a log-wavelength
+            grid in the rest frame. Compared to smoothing in the observed frame,
+            the resampling onto a different log-wavelength grid changes the
+            fluxes by up to ~1e-4 (relative to the maximum flux) for very small
+            vdisp, ~1e-5 at 30 km/s and ~1e-6 at 150 km/s, well below the
+            accuracy of the emulator. 
 
         wavelength : array_like[Nwave,]
             If you want to use your own wavelength. If specified, the model
@@ -82,38 +112,58 @@ class Model(object):
         Returns
         -------
         outwave : [Nsample, Nwave]
-            output wavelengths in angstrom. 
+            output wavelengths in angstrom. If `wavelength` is not specified
+            and vdisp > 0, this is the rest-frame log-wavelength grid used
+            for velocity dispersion (10 km/s pixels from 10A above the
+            shortest to 10A below the longest rest-frame wavelength)
+            redshifted to `zred`. 
 
         outspec : [Nsample, Nwave]
             the redshifted SED in units of 1e-17 * erg/s/cm^2/Angstrom.
         '''
         tt      = np.atleast_2d(tt)
         zred    = np.atleast_1d(zred) 
-        vdisp   = np.atleast_1d(vdisp) 
         ntheta  = tt.shape[1]
 
         assert tt.shape[0] == zred.shape[0]
+        vdisp   = np.broadcast_to(vdisp, zred.shape) 
+
+        #tage = self.cosmo.age(zred).value 
+        tage = self._tage_z_interp(zred)
+
+        # get SSP luminosity of all samples 
+        wave_rest, lum_ssp = self._sps_model_batch(tt, tage)
+
+        # redshift the spectra
+        w_z = wave_rest[None,:] * (1. + zred[:,None])
+        d_lum = self._d_lum_z_interp(zred) 
+        #flux_z = lum_ssp * UT.Lsun() / (4. * np.pi * d_lum**2) / (1. + zred) * 1e17 # 10^-17 ergs/s/cm^2/Ang
+        flux_z = lum_ssp * (3.846e50 / (4. * np.pi * d_lum**2) / (1. + zred))[:,None] # 10^-17 ergs/s/cm^2/Ang
        
+        # apply velocity dispersion. This is done in the rest-frame, where
+        # the wavelength grid is the same for all samples, and is
+        # equivalent to applying it to the redshifted spectrum. All samples
+        # are put on the log-wavelength grid so that they share the same grid
+        smooth = np.any(vdisp > 0) 
+        if smooth: 
+            wlog, flux_wlog = self._apply_vdisp(wave_rest, flux_z, vdisp)
+
+        if wavelength is not None: 
+            # the output wavelength and resolution matrices are the same for
+            # all samples 
+            wave_sorted = np.all(np.diff(wavelength) >= 0) 
+            if not wave_sorted: isort = np.argsort(wavelength)
+            if resolution is not None: 
+                resolutions = [UT.Resolution(res) for res in np.atleast_1d(resolution)]
+
         outwave, outspec, maggies = [], [], [] 
-        for _tt, _zred in zip(tt, zred): 
-            #_tage = self.cosmo.age(_zred).value 
-            _tage = self._tage_z_interp(_zred)
-
-            # get SSP luminosity
-            wave_rest, lum_ssp = self._sps_model(_tt, _tage)
-
-            # redshift the spectra
-            w_z = wave_rest * (1. + _zred)
-            d_lum = self._d_lum_z_interp(_zred) 
-            #flux_z = lum_ssp * UT.Lsun() / (4. * np.pi * d_lum**2) / (1. + _zred) * 1e17 # 10^-17 ergs/s/cm^2/Ang
-            flux_z = lum_ssp * 3.846e50 / (4. * np.pi * d_lum**2) / (1. + _zred) # 10^-17 ergs/s/cm^2/Ang
-    
-            # apply velocity dispersion 
-            if vdisp == 0: 
-                wave_smooth = w_z 
-                flux_smooth = flux_z
+        for i in range(tt.shape[0]): 
+            if smooth: 
+                wave_smooth = wlog * (1. + zred[i]) 
+                flux_smooth = flux_wlog[i]
             else: 
-                wave_smooth, flux_smooth = self._apply_vdisp(w_z, flux_z, vdisp)
+                wave_smooth = w_z[i]
+                flux_smooth = flux_z[i]
 
             if wavelength is None: 
                 outwave.append(wave_smooth)
@@ -122,10 +172,9 @@ class Model(object):
                 outwave.append(wavelength)
                 
                 # resample flux to input wavelength  
-                if np.all(np.diff(wavelength) >=0): 
+                if wave_sorted: 
                     resampflux = UT.trapz_rebin(wave_smooth, flux_smooth, xnew=wavelength) 
                 else: 
-                    isort = np.argsort(wavelength)
                     resampflux = np.zeros(len(wavelength))
                     resampflux[isort] = UT.trapz_rebin(wave_smooth, flux_smooth,
                             xnew=wavelength[isort]) 
@@ -133,18 +182,17 @@ class Model(object):
                 if resolution is not None: 
                     # apply resolution matrix 
                     _i = 0 
-                    for res in np.atleast_1d(resolution):
-                        _res = UT.Resolution(res) 
-                        resampflux[_i:_i+res.shape[-1]] = _res.dot(resampflux[_i:_i+res.shape[-1]]) 
-                        _i += res.shape[-1]
+                    for _res in resolutions: 
+                        resampflux[_i:_i+_res.shape[-1]] = _res.dot(resampflux[_i:_i+_res.shape[-1]]) 
+                        _i += _res.shape[-1]
                 outspec.append(resampflux) 
 
             if filters is not None: 
                 # calculate photometry from SEDs 
-                flux_z, w_z = filters.pad_spectrum(np.atleast_2d(flux_z) *
+                _flux_z, _w_z = filters.pad_spectrum(np.atleast_2d(flux_z[i]) *
                         1e-17*U.erg/U.s/U.cm**2/U.Angstrom,
-                        w_z * U.Angstrom)
-                _maggies = filters.get_ab_maggies(flux_z, wavelength=w_z)
+                        w_z[i] * U.Angstrom)
+                _maggies = filters.get_ab_maggies(_flux_z, wavelength=_w_z)
                 maggies.append(np.array(list(_maggies[0])) * 1e9)
 
         if len(outwave) == 1: 
@@ -164,40 +212,164 @@ class Model(object):
     def _init_model(self, **kwargs) : 
         return None 
 
+    def _tage_z(self, zred): 
+        ''' age of the universe in Gyr at redshift `zred`. Within the
+        redshift range of the interpolator (0 < z < 0.5) the interpolator is
+        used instead of the much slower astropy calculation. 
+        '''
+        if np.all((zred >= 0.) & (zred <= 0.5)): 
+            tage = self._tage_z_interp(zred)
+            return float(tage) if np.ndim(tage) == 0 else tage 
+        return self.cosmo.age(zred).value 
+
+    def _sps_model_batch(self, tt, tage): 
+        ''' SSP luminosity for a batch of parameter values. By default
+        `_sps_model` is evaluated one sample at a time. Models that can
+        evaluate the whole batch at once (e.g. emulators) override this.
+
+        Parameters
+        ----------
+        tt : 2d array
+            [Nsample,Nparam] SPS parameters
+
+        tage : 1d array 
+            [Nsample] age of galaxy 
+
+        Returns
+        -------
+        wave_rest : array_like[Nwave] 
+            rest-frame wavelength of SSP flux 
+
+        lum_ssp : array_like[Nsample,Nwave]
+            SSP luminosity in units of Lsun/A
+        '''
+        lum_ssp = [] 
+        for _tt, _tage in zip(tt, tage): 
+            wave_rest, _lum_ssp = self._sps_model(_tt, _tage)
+            lum_ssp.append(_lum_ssp) 
+        return wave_rest, np.array(lum_ssp)
+
     def _apply_vdisp(self, wave, flux, vdisp): 
         ''' apply velocity dispersion by first rebinning to log-scale
         wavelength then convolving vdisp. 
 
+        Parameters
+        ----------
+        wave : array_like[Nwave]
+            wavelength 
+
+        flux : array_like[Nwave] or array_like[N,Nwave]
+            flux of one or N spectra on `wave` 
+
+        vdisp : float or array_like[N]
+            velocity dispersion of each spectrum 
+
         Notes
         -----
         * code lift from https://github.com/desihub/desigal/blob/d67a4350bc38ae42cf18b2db741daa1a32511f8d/py/desigal/nyxgalaxy.py#L773
         * confirmed that it reproduces the velocity dispersion calculations in
         prospector
         (https://github.com/bd-j/prospector/blob/41cbdb7e6a13572baea59b75c6c10100e7c7e212/prospect/utils/smoothing.py#L17)
+        * spectra are rebinned together and spectra with the same vdisp are
+          convolved together. Spectra with vdisp <= 0 are rebinned but not
+          convolved. 
         '''
-        if vdisp <= 0: 
+        vdisp = np.broadcast_to(vdisp, flux.shape[:-1])
+        if np.all(vdisp <= 0): 
             return wave, flux
-        from scipy.ndimage import gaussian_filter1d
         pixkms = 10.0                                 # SSP pixel size [km/s]
-        dlogwave = pixkms / 2.998e5 / np.log(10)
-        wlog = 10**np.arange(np.log10(wave.min() + 10.), np.log10(wave.max() - 10.), dlogwave)
-        flux_wlog = UT.trapz_rebin(wave, flux, xnew=wlog, edges=None)
-        # convolve  
-        sigma = vdisp / pixkms # in pixels 
-        smoothflux = gaussian_filter1d(flux_wlog, sigma=sigma, axis=0)
+
+        # rebin to log-scale wavelength grid 
+        wlog, R = self._vdisp_grid(wave, pixkms=pixkms) 
+        flux_wlog = R.dot(flux.T).T
+
+        # convolve with a gaussian kernel. This is equivalent to
+        # scipy.ndimage.gaussian_filter1d but the kernel is cached
+        _vdisps = np.unique(vdisp)
+        if len(_vdisps) == 1: 
+            return wlog, self._convolve(flux_wlog, self._gaussian_kernel(_vdisps[0] / pixkms))
+
+        smoothflux = np.empty(flux_wlog.shape)
+        for _vdisp in _vdisps: 
+            same = (vdisp == _vdisp) 
+            if _vdisp <= 0: 
+                smoothflux[same] = flux_wlog[same]
+                continue 
+            smoothflux[same] = self._convolve(flux_wlog[same], 
+                    self._gaussian_kernel(_vdisp / pixkms))
         return wlog, smoothflux
+
+    @staticmethod
+    def _convolve(flux, kernel): 
+        ''' convolve flux with a symmetric kernel along the last axis with
+        'reflect' boundaries (same as `scipy.ndimage.convolve1d`). Wide
+        kernels are convolved with overlap-add FFT convolution, which is
+        faster than direct convolution for kernels wider than ~100 pixels. 
+        '''
+        if len(kernel) < 100: 
+            return convolve1d(flux, kernel, axis=-1, mode='reflect')
+
+        r = len(kernel) // 2 
+        # numpy's 'symmetric' padding is scipy.ndimage's 'reflect' mode
+        _flux = np.pad(flux, [(0, 0)] * (flux.ndim - 1) + [(r, r)], mode='symmetric')
+        return oaconvolve(_flux, kernel.reshape((1,) * (flux.ndim - 1) + (-1,)),
+                mode='valid', axes=-1)
+
+    def _vdisp_grid(self, wave, pixkms=10.): 
+        ''' log-scale wavelength grid with `pixkms` km/s pixels used to
+        apply velocity dispersion and the sparse matrix for trapezoidal
+        rebinning from `wave` onto it (see `UT.build_trapz_rebin_matrix`).
+        Building the matrix costs several times more than a single
+        `UT.trapz_rebin`, but the input wavelength grid is fixed (e.g. the
+        rest-frame emulator wavelengths), so the grid and matrix are built
+        once. The 16 most recently used are cached, keyed on the values of
+        `wave`. 
+        '''
+        key = (np.ascontiguousarray(wave).tobytes(), pixkms) 
+        grid = self._vdisp_grids.get(key) 
+        if grid is None: 
+            dlogwave = pixkms / 2.998e5 / np.log(10)
+            wlog = 10**np.arange(np.log10(wave.min() + 10.), np.log10(wave.max() - 10.), dlogwave)
+            grid = (wlog, UT.build_trapz_rebin_matrix(wave, xnew=wlog))
+            if len(self._vdisp_grids) >= 16: self._vdisp_grids.popitem(last=False) 
+            self._vdisp_grids[key] = grid
+        else: 
+            self._vdisp_grids.move_to_end(key) 
+        return grid 
+
+    def _gaussian_kernel(self, sigma, truncate=4.0): 
+        ''' normalized gaussian kernel with standard deviation `sigma` (in
+        pixels) truncated at `truncate` sigma. Same kernel as
+        `scipy.ndimage.gaussian_filter1d`. Kernels are cached with sigma
+        quantized to 0.001 pixels, so that nearby values of sigma (e.g.
+        during sampling) reuse the same kernel. Sigma that rounds to 0 gives
+        the identity kernel. 
+        '''
+        key = int(round(float(sigma) * 1000))
+        if key <= 0: 
+            return np.ones(1) 
+
+        kernel = self._vdisp_kernels.get(key) 
+        if kernel is None: 
+            sigma = key / 1000. 
+            radius = int(truncate * sigma + 0.5)
+            x = np.arange(-radius, radius+1)
+            kernel = np.exp(-0.5 / sigma**2 * x**2)
+            kernel /= kernel.sum()
+            if len(self._vdisp_kernels) >= 256: self._vdisp_kernels.clear() 
+            self._vdisp_kernels[key] = kernel
+        return kernel 
     
     def _parse_theta(self, tt):
-        ''' parse given array of parameter values 
+        ''' parse given array of parameter values into a namedtuple of the
+        parameter columns (e.g. `theta.logmstar`). The columns are views of
+        `tt`, so they should not be modified in place. 
         '''
-        tt = np.atleast_2d(tt.copy()) 
+        tt = np.atleast_2d(tt) 
 
         assert tt.shape[1] == len(self._parameters), 'given theta has %i instead of %i dims' % (tt.shape[1], len(self._parameters))
 
-        theta = {} 
-        for i, param in enumerate(self._parameters): 
-            theta[param] = tt[:,i]
-        return theta 
+        return self._Theta(*tt.T)
 
 
 class NMF(Model): 
@@ -237,19 +409,30 @@ class NMF(Model):
         specify cosmology. If cosmo=None, NMF uses astorpy.cosmology.Planck13 
         by default.
 
+    n_thr : int
+        number of points of the high resolution lookback time grid that the
+        SFH bases are tabulated and integrated on. Compared to the default,
+        a grid of 20000 (5000) points changes the SFHs by <1e-5 (<2e-4). The
+        cost of evaluating the SFH does not depend on it. (default: 50000) 
+
 
     Notes 
     -----
     * only supports 4 component SFH with or without burst and 2 component ZH 
     * only supports Calzetti+(2000) attenuation curve) and Chabrier IMF. 
     '''
-    def __init__(self, burst=True, emulator=False, cosmo=None): 
+    def __init__(self, burst=True, emulator=False, cosmo=None, n_thr=int(5e4)): 
         self._ssp = None 
         self._burst = burst
         self._emulator = emulator 
+        self._n_thr = n_thr 
         # metallicity range set by MIST isochrone
         self._Z_min = 4.49043431e-05
         self._Z_max = 4.49043431e-02
+        # cache of SFH basis weights for avgSFR 
+        self._avgsfr_weights = {} 
+        # cache of SFH and ZH bases on the lookback time bins of each tage
+        self._tlb_bases = {} 
         super().__init__(cosmo=cosmo) # initializes the model
 
     def _emu(self, tt, tage): 
@@ -259,10 +442,10 @@ class NMF(Model):
 
         Parameters 
         ----------
-        tt : 1d array 
-            Nparam array that specifies the parameter values 
+        tt : 1d or 2d array 
+            Nparam or NxNparam array that specifies the parameter values 
 
-        tage : float 
+        tage : float or 1d array
             age of galaxy 
         
         Returns
@@ -270,7 +453,7 @@ class NMF(Model):
         wave_rest : array_like[Nwave] 
             rest-frame wavelength of SSP flux 
 
-        lum_ssp : array_like[Nwave] 
+        lum_ssp : array_like[Nwave] or array_like[N,Nwave]
             FSPS SSP luminosity in units of Lsun/A
     
 
@@ -278,46 +461,51 @@ class NMF(Model):
         -----
         * June 11, 2021: burst component no longer uses an emulator because
             it's fast enough.
+        * the emulator is evaluated on the whole batch of parameter values at
+          once. 
         '''
         theta = self._parse_theta(tt) 
+        tage = np.broadcast_to(tage, theta.logmstar.shape)
         
-        assert np.isclose(np.sum([theta['beta1_sfh'], theta['beta2_sfh'],
-            theta['beta3_sfh'], theta['beta4_sfh']]), 1.), "SFH basis coefficients should add up to 1"
+        assert np.allclose(theta.beta1_sfh + theta.beta2_sfh +
+            theta.beta3_sfh + theta.beta4_sfh, 1.), "SFH basis coefficients should add up to 1"
     
         # get redshift with interpolation 
         #zred = self._z_tage_interp(tage) 
     
-        tt_nmf = np.concatenate([theta['beta1_sfh'], theta['beta2_sfh'],
-            theta['beta3_sfh'], theta['beta4_sfh'], theta['gamma1_zh'],
-            theta['gamma2_zh'], theta['dust1'], theta['dust2'],
-            theta['dust_index'], [tage]])#zred]])
+        tt_nmf = np.stack([theta.beta1_sfh, theta.beta2_sfh,
+            theta.beta3_sfh, theta.beta4_sfh, theta.gamma1_zh,
+            theta.gamma2_zh, theta.dust1, theta.dust2,
+            theta.dust_index, tage], axis=1)#zred]])
         
-        assert theta['gamma2_zh'] < 2.0e-2
-        assert theta['gamma1_zh'] > 4.5e-5
+        assert np.all(theta.gamma2_zh < 2.0e-2)
+        assert np.all(theta.gamma1_zh > 4.5e-5)
         # NMF from emulator 
         lum_ssp = np.exp(self._emu_nmf(tt_nmf)) 
    
         # add burst contribution 
         if self._burst: 
-            fburst = theta['fburst']
-            tburst = theta['tburst'] 
+            fburst = theta.fburst
+            tburst = theta.tburst 
 
             lum_burst = np.zeros(lum_ssp.shape)
             # if starburst is within the age of the galaxy 
-            if tburst < tage and fburst > 0.: 
-                lum_burst = np.exp(self._emu_burst(tt))
+            has_burst = (tburst < tage) & (fburst > 0.)
+            if np.any(has_burst): 
+                lum_burst[has_burst] = np.exp(self._emu_burst(np.atleast_2d(tt)[has_burst]))
                 #_w, _lum_burst = self._fsps_burst(tt)
                 #lum_burst = _lum_burst[(_w > 2300.) & (_w < 60000.)]
 
             # renormalize NMF contribution  
-            lum_ssp *= (1. - fburst) 
+            lum_ssp *= (1. - fburst)[:,None]
 
             # add in burst contribution 
-            lum_ssp += fburst * lum_burst
+            lum_ssp += fburst[:,None] * lum_burst
 
         # normalize by stellar mass 
-        lum_ssp *= (10**theta['logmstar'])
+        lum_ssp *= (10**theta.logmstar)[:,None]
 
+        if np.ndim(tt) == 1: return self._nmf_emu_waves, lum_ssp[0]
         return self._nmf_emu_waves, lum_ssp
 
     def _fsps(self, tt, tage): 
@@ -357,8 +545,8 @@ class NMF(Model):
         if self._ssp is None: self._ssp_initiate()  # initialize FSPS StellarPopulation object
         theta = self._parse_theta(tt) 
         
-        assert np.isclose(np.sum([theta['beta1_sfh'], theta['beta2_sfh'],
-            theta['beta3_sfh'], theta['beta4_sfh']]), 1.), "SFH basis coefficients should add up to 1"
+        assert np.isclose(np.sum([theta.beta1_sfh, theta.beta2_sfh,
+            theta.beta3_sfh, theta.beta4_sfh]), 1.), "SFH basis coefficients should add up to 1"
         
         # NMF SFH(t) noramlized to 1 **without burst**
         tlb_edges, sfh = self.SFH(np.concatenate([[0.], tt[1:]]), tage=tage, _burst=False)  
@@ -368,27 +556,32 @@ class NMF(Model):
         tages = 0.5 * (tlb_edges[1:] + tlb_edges[:-1]) # ages of SSP
         dt = np.diff(tlb_edges) # bin widths
     
-        # look over log-spaced lookback time bins and add up SSPs
-        for i, tage in enumerate(tages): 
-            m = 1e9 * dt[i] * sfh[i] # mass formed in this bin 
-            if m == 0 and i != 0: continue 
+        # SSPs are added up in a preallocated buffer 
+        wave_rest = self._ssp.wavelengths
+        lum_ssp = self._lum_ssp_buf 
+        lum_ssp.fill(0.) 
+
+        # dust parameters are the same for all SSPs 
+        self._ssp.params['dust1'] = theta.dust1
+        self._ssp.params['dust2'] = theta.dust2  
+        self._ssp.params['dust_index'] = theta.dust_index
 
+        mass = 1e9 * dt * sfh # mass formed in each bin 
+
+        # look over log-spaced lookback time bins with star formation and add up SSPs
+        for i in np.flatnonzero(mass != 0): 
             self._ssp.params['logzsol'] = np.log10(zh[i]/0.0190) # log(Z/Zsun)
-            self._ssp.params['dust1'] = theta['dust1']
-            self._ssp.params['dust2'] = theta['dust2']  
-            self._ssp.params['dust_index'] = theta['dust_index']
             
-            wave_rest, lum_i = self._ssp.get_spectrum(tage=tage, peraa=True) # in units of Lsun/AA
+            _, lum_i = self._ssp.get_spectrum(tage=tages[i], peraa=True) # in units of Lsun/AA
             # note that this spectrum is normalized such that the total formed
             # mass = 1 Msun
 
-            if i == 0: lum_ssp = np.zeros(len(wave_rest))
-            lum_ssp += m * lum_i 
+            lum_ssp += mass[i] * lum_i 
     
         # add burst contribution 
         if self._burst: 
-            fburst = theta['fburst']
-            tburst = theta['tburst'] 
+            fburst = theta.fburst
+            tburst = theta.tburst 
 
             lum_burst = np.zeros(lum_ssp.shape)
             # if starburst is within the age of the galaxy 
@@ -401,8 +594,9 @@ class NMF(Model):
             # add in burst contribution 
             lum_ssp += fburst * lum_burst
 
-        # normalize by stellar mass 
-        lum_ssp *= (10**theta['logmstar'])
+        # normalize by stellar mass (out of place so that the returned
+        # spectrum does not share memory with the buffer)
+        lum_ssp = lum_ssp * (10**theta.logmstar)
 
         return wave_rest, lum_ssp
 
@@ -414,14 +608,13 @@ class NMF(Model):
         '''
         if self._ssp is None: self._ssp_initiate()  # initialize FSPS StellarPopulation object
         theta = self._parse_theta(tt) 
-        tt_zh = np.array([theta['gamma1_zh'], theta['gamma2_zh']])
+        tt_zh = np.array([theta.gamma1_zh, theta.gamma2_zh])
 
-        tburst = theta['tburst'] 
+        tburst = theta.tburst 
         assert tburst > 1e-2, "burst currently only supported for tburst > 1e-2 Gyr"
 
         # get metallicity at tburst 
-        zburst = np.sum(np.array([tt_zh[i] * self._zh_basis[i](tburst) 
-            for i in range(self._N_nmf_zh)])).clip(self._Z_min, self._Z_max) 
+        zburst = np.sum(tt_zh * self._zh_basis_eval(tburst)).clip(self._Z_min, self._Z_max) 
         
         if debug:
             print('zburst=%e' % zburst) 
@@ -431,8 +624,8 @@ class NMF(Model):
         # luminosity of SSP at tburst 
         self._ssp.params['logzsol'] = np.log10(zburst/0.0190) # log(Z/Zsun)
         self._ssp.params['dust1'] = 0. # no birth cloud attenuation for tage > 1e-2 Gyr
-        self._ssp.params['dust2'] = theta['dust2']
-        self._ssp.params['dust_index'] = theta['dust_index'] 
+        self._ssp.params['dust2'] = theta.dust2
+        self._ssp.params['dust_index'] = theta.dust_index 
         
         wave_rest, lum_burst = self._ssp.get_spectrum(tage=tburst, peraa=True) # in units of Lsun/AA
         # note that this spectrum is normalized such that the total formed
@@ -444,48 +637,25 @@ class NMF(Model):
         
         Parameters
         ----------
-        tt : 1d array 
-            Nparam array that specifies 
+        tt : 1d or 2d array 
+            Nparam or NxNparam array that specifies 
             [beta1_sfh, beta2_sfh, beta3_sfh, beta4_sfh, gamma1_zh, gamma2_zh, dust1, dust2, dust_index, redshift] 
     
         Returns
         -------
-        logflux : array_like[Nwave,] 
+        logflux : array_like[Nwave,] or array_like[N,Nwave]
             (natural) log of (SSP luminosity in units of Lsun/A)
         '''
-        # untransform SFH coefficients from Dirichlet distribution 
-        _tt = np.empty(9)
-        _tt[0] = (1. - tt[0]).clip(1e-8, None)
-        for i in range(1,3): 
-            _tt[i] = 1. - (tt[i] / np.prod(_tt[:i]))
-        _tt[3:] = tt[4:]
-
-        logflux = [] 
-        for iwave in range(self._nmf_n_emu): # wave bins
-            W_, b_, alphas_, betas_, parameters_shift_, parameters_scale_,\
-                    pca_shift_, pca_scale_, spectrum_shift_, spectrum_scale_,\
-                    pca_transform_matrix_ = self._nmf_emu_params[iwave][:11]
-            n_layers = self._nmf_emu_params[iwave][-2]
-
-            # forward pass through the network
-            act = []
-            layers = [(_tt - parameters_shift_)/parameters_scale_]
-            for i in range(n_layers-1):
-
-                # linear network operation
-                act.append(np.dot(layers[-1], W_[i]) + b_[i])
-
-                # pass through activation function
-                layers.append((betas_[i] + (1.-betas_[i])*1./(1.+np.exp(-alphas_[i]*act[-1])))*act[-1])
-
-            # final (linear) layer -> (normalized) PCA coefficients
-            layers.append(np.dot(layers[-1], W_[-1]) + b_[-1])
-
-            # rescale PCA coefficients, multiply out PCA basis -> normalized spectrum, shift and re-scale spectrum -> output spectrum
-            logflux.append(np.dot(layers[-1]*pca_scale_ + pca_shift_,
-                pca_transform_matrix_)*spectrum_scale_ + spectrum_shift_)
-
-        return np.concatenate(logflux) 
+        # untransform SFH coefficients from Dirichlet distribution. The
+        # product of the preceding untransformed coefficients is the remaining
+        # "stick" _tt[0] - tt[1] - ... - tt[i-1], so it is a cumulative sum
+        _tt = np.empty(tt.shape[:-1] + (9,))
+        _tt[...,0] = (1. - tt[...,0]).clip(1e-8, None)
+        stick = np.cumsum(np.concatenate([_tt[...,:1], -tt[...,1:2]], axis=-1), axis=-1)
+        _tt[...,1:3] = 1. - tt[...,1:3] / stick
+        _tt[...,3:] = tt[...,4:]
+
+        return self._emu_nn(_tt, self._nmf_emu_params)
    
     def _emu_burst(self, tt, debug=False): 
         ''' calculate the dust attenuated luminosity contribution from a SSP
@@ -498,100 +668,223 @@ class NMF(Model):
         to FSPS numerical accuracy  
         '''
         theta = self._parse_theta(tt) 
-        tt_zh = np.array([theta['gamma1_zh'], theta['gamma2_zh']])
+        tt_zh = np.array([theta.gamma1_zh, theta.gamma2_zh])
+
+        tburst = theta.tburst 
 
-        tburst = theta['tburst'] 
+        logflux = np.zeros((len(tburst), len(self._nmf_emu_waves)))
 
-        if tburst > 13.27: 
+        valid = (tburst <= 13.27)
+        if not np.all(valid): 
             warnings.warn('tburst > 13.27 Gyr returns 0s --- modify priors')
-            return np.zeros(len(self._nmf_emu_waves))
-        assert tburst > 1e-2, "burst currently only supported for tburst > 1e-2 Gyr"
+        if np.any(valid): 
+            assert np.all(tburst[valid] > 1e-2), "burst currently only supported for tburst > 1e-2 Gyr"
 
-        #dust1           = theta['dust1']
-        dust2           = theta['dust2']
-        dust_index      = theta['dust_index']
+            # get metallicity at tburst 
+            zburst = np.einsum('ij,ij->j', tt_zh[:,valid],
+                    self._zh_basis_eval(tburst[valid])).clip(self._Z_min, self._Z_max) 
 
-        # get metallicity at tburst 
-        zburst = np.sum(np.array([tt_zh[i] * self._zh_basis[i](tburst) 
-            for i in range(self._N_nmf_zh)])).clip(self._Z_min, self._Z_max) 
+            # input to emulator are [tburst, zburst, dust2, dust_index]
+            _tt = np.stack([
+                tburst[valid], 
+                zburst, 
+                theta.dust2[valid], 
+                theta.dust_index[valid]], axis=1)
 
-        # input to emulator are [tburst, zburst, dust2, dust_index]
-        tt = np.array([
-            tburst, 
-            [zburst], 
-            theta['dust2'], 
-            theta['dust_index']]).flatten()
+            logflux[valid] = self._emu_burst_nn(_tt)
 
-        return self._emu_burst_nn(tt)
+        if np.ndim(tt) == 1: return logflux[0]
+        return logflux 
     
     def _emu_burst_nn(self, tt): 
         ''' burst emulator neural network 
         '''
-        logflux = [] 
-        for iwave in range(self._burst_n_emu): # wave bins
-            W_, b_, alphas_, betas_, parameters_shift_, parameters_scale_,\
-                    pca_shift_, pca_scale_, spectrum_shift_, spectrum_scale_,\
-                    pca_transform_matrix_ = self._burst_emu_params[iwave][:11]
-            n_layers = self._burst_emu_params[iwave][-2]
-
-            # forward pass through the network
-            act = []
-            layers = [(tt - parameters_shift_)/parameters_scale_]
-            for i in range(n_layers-1):
-                # linear network operation
-                act.append(np.matmul(layers[-1], W_[i]) + b_[i])
-                
-                # pass through activation function
-                layers.append((betas_[i] + (1.-betas_[i])*1./(1.+np.exp(-alphas_[i]*act[-1])))*act[-1])
+        return self._emu_nn(tt, self._burst_emu_params)
+
+    def _emu_nn(self, tt, emu_params): 
+        ''' forward pass through a PCA neural network emulator that is split
+        into wavelength bins. All wavelength bins are evaluated for the whole
+        batch of inputs with the compiled `UT.emu_forward`. Large batches are
+        split into tiles of rows so that the hidden layer activations of a
+        tile stay in the L2 cache. 
+
+        Parameters
+        ----------
+        tt : array_like[Nin,] or array_like[N,Nin]
+            input parameters of the emulator 
 
-            # final (linear) layer -> (normalized) PCA coefficients
-            layers.append(np.matmul(layers[-1], W_[-1]) + b_[-1])
+        emu_params : EmuParams
+            stacked emulator parameters of the wavelength bins (see
+            `_emu_kernel_params`)
 
-            # rescale PCA coefficients, multiply out PCA basis -> normalized spectrum, shift and re-scale spectrum -> output spectrum
-            logflux.append(np.matmul(layers[-1]*pca_scale_ + pca_shift_,
-                pca_transform_matrix_)*spectrum_scale_ + spectrum_shift_)
-        return np.concatenate(logflux) 
+        Returns
+        -------
+        logflux : array_like[Nwave,] or array_like[N,Nwave]
+            output of the emulator 
+        '''
+        _tt = np.ascontiguousarray(np.atleast_2d(tt), 
+                dtype=emu_params.param_shift.dtype)
+
+        # tile size: input and output activations of a tile (float32) take
+        # up half of the L2 cache 
+        tile = max(64, self._l2_bytes // (4 * 4 * emu_params.W_hid.shape[-1]))
+
+        if _tt.shape[0] <= tile: 
+            logflux = UT.emu_forward(_tt, *emu_params)
+        else: 
+            logflux = np.empty((_tt.shape[0], emu_params.wave_index[-1]))
+            for i0 in range(0, _tt.shape[0], tile): 
+                logflux[i0:i0+tile] = UT.emu_forward(_tt[i0:i0+tile], *emu_params)
+
+        if np.ndim(tt) == 1: return logflux[0]
+        return logflux 
+
+    @staticmethod
+    def _emu_kernel_params(emu_params): 
+        ''' stack the pickled parameters of the wavelength bins of an
+        emulator into the arguments of `UT.emu_forward`. The layers of the
+        wavelength bins are stacked along the first axis and the final layer
+        and PCA coefficients are zero-padded to the largest number of PCA
+        components. The PCA bases, which have different numbers of
+        wavelengths, are kept as a tuple. All arrays are contiguous float32
+        arrays. The emulators are only accurate to <1%, so there is nothing
+        to gain from evaluating them in double precision.
+
+        Parameters
+        ----------
+        emu_params : list
+            pickled parameters of each wavelength bin
+
+        Returns
+        -------
+        EmuParams
+        '''
+        npca = max([params[6].shape[0] for params in emu_params])
+
+        _arr = lambda a: np.ascontiguousarray(a, dtype=np.float32)
+        # zero-pad the last axis to npca
+        _pad = lambda a: np.pad(a, [(0, 0)] * (np.ndim(a)-1) + [(0, npca - a.shape[-1])])
+        # stack over the wavelength bins 
+        _stack = lambda f: _arr(np.stack([f(params) for params in emu_params]))
+
+        return EmuParams(
+                _stack(lambda p: p[4]), _stack(lambda p: p[5]),
+                _stack(lambda p: p[0][0]), _stack(lambda p: p[1][0]),
+                _stack(lambda p: np.stack(p[0][1:-1])),
+                _stack(lambda p: np.stack(p[1][1:-1])), 
+                _stack(lambda p: np.stack(p[2])), 
+                _stack(lambda p: np.stack(p[3])), 
+                _stack(lambda p: _pad(p[0][-1])), _stack(lambda p: _pad(p[1][-1])),
+                _stack(lambda p: _pad(p[6])), _stack(lambda p: _pad(p[7])),
+                tuple([_arr(_pad(params[10].T).T) for params in emu_params]),
+                _arr(np.concatenate([params[8] for params in emu_params])),
+                _arr(np.concatenate([params[9] for params in emu_params])),
+                np.cumsum([0] + [params[10].shape[-1] for params in emu_params]))
     
-    def _load_emulator(self): 
-        ''' read in pickle files that contains the parameters for the FSPS
-        emulator that is split into wavelength bins
+    @staticmethod
+    def _emu_files(emu): 
+        ''' .npz file of the stacked parameters (see `_write_emulator_npz`)
+        and pickle files of the wavelength bins of the FSPS emulator `emu`,
+        which is either 'nmf' or 'burst'
         '''
+        dat_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'dat')
         wbins = ['2000_3600', '3600_5500', '5500_7410', '7410_60000']
-        # load NMF emulator 
         npcas = [50, 50, 50, 30]
-        f_nn = lambda npca, i: 'nmf.v0.1.seed0_99.w%s.pca%i.8x256.nbatch250.pkl' % (wbins[i], npca)
-        
-        self._nmf_n_emu         = len(npcas)
-        self._nmf_emu_params    = [] 
-        self._nmf_emu_wave      = [] 
-
-        for i, npca in enumerate(npcas): 
-            fpkl = open(os.path.join(
-                os.path.dirname(os.path.realpath(__file__)), 'dat', 
-                f_nn(npca, i)), 'rb')
-            params = pickle.load(fpkl)
-
-            self._nmf_emu_params.append(params)
-            self._nmf_emu_wave.append(params[13])
-        
-        self._nmf_emu_waves = np.concatenate(self._nmf_emu_wave) 
+        if emu == 'nmf': 
+            f_nn = lambda npca, i: 'nmf.v0.1.seed0_99.w%s.pca%i.8x256.nbatch250.pkl' % (wbins[i], npca)
+        elif emu == 'burst': 
+            f_nn = lambda npca, i: 'burst.v0.1.seed0_199.w%s.pca%i.6x512.nbatch250.pkl' % (wbins[i], npca)
+        else: 
+            raise ValueError("emulator has to be 'nmf' or 'burst'")
+
+        fnpz = os.path.join(dat_dir, 'fsps.%s.stacked.npz' % emu)
+        fpkls = [os.path.join(dat_dir, f_nn(npca, i)) for i, npca in enumerate(npcas)]
+        return fnpz, fpkls
+
+    @classmethod
+    def _read_emulator(cls, emu, npz=True): 
+        ''' read in the parameters of the FSPS emulator `emu` ('nmf' or
+        'burst'), which is split into wavelength bins, stacked for
+        `UT.emu_forward`. The parameters are read from the .npz file written
+        by `_write_emulator_npz`, which only holds plain arrays and is much
+        faster to read than the pickle files. If it does not exist, is
+        older than any of the pickle files, or `npz=False`, they are read
+        from the pickle files. 
+
+        Returns
+        -------
+        emu_params : EmuParams
+            stacked emulator parameters 
+
+        wave : array_like[Nwave,]
+            wavelengths of the emulator 
+        '''
+        fnpz, fpkls = cls._emu_files(emu)
+
+        if npz and os.path.isfile(fnpz): 
+            t_pkl = max([os.path.getmtime(fpkl) for fpkl in fpkls if os.path.isfile(fpkl)] + [0.])
+            if os.path.getmtime(fnpz) < t_pkl: 
+                warnings.warn('%s is older than the emulator pickle files; '
+                        'reading the pickle files instead. Rerun '
+                        'bin/stack_emulator.py to update it.' % fnpz)
+                npz = False 
+
+        if npz and os.path.isfile(fnpz): 
+            with np.load(fnpz) as _npz: 
+                n_bin = len(_npz['wave_index']) - 1
+                pca_transform = tuple([_npz['pca_transform%i' % i] for i in range(n_bin)])
+                emu_params = EmuParams(*[
+                    pca_transform if field == 'pca_transform' else _npz[field] 
+                    for field in EmuParams._fields])
+                wave = _npz['wavelengths']
+            return emu_params, wave
+
+        params = [] 
+        for fpkl in fpkls: 
+            with open(fpkl, 'rb') as _fpkl: 
+                params.append(pickle.load(_fpkl))
+        wave = np.concatenate([_params[13] for _params in params])
+        return cls._emu_kernel_params(params), wave
+
+    @classmethod
+    def _write_emulator_npz(cls, emu): 
+        ''' convert the pickle files of the FSPS emulator `emu` ('nmf' or
+        'burst') into a single uncompressed .npz file of the stacked
+        parameters that `_read_emulator` reads. The PCA bases of the
+        wavelength bins are stored as `pca_transform0`, `pca_transform1`, ...
+        '''
+        emu_params, wave = cls._read_emulator(emu, npz=False)
+        fnpz, _ = cls._emu_files(emu)
+
+        arrs = emu_params._asdict() 
+        for i, pca_transform in enumerate(arrs.pop('pca_transform')): 
+            arrs['pca_transform%i' % i] = pca_transform
+        np.savez(fnpz, wavelengths=wave, **arrs)
+        return fnpz 
+
+    def _load_emulator(self): 
+        ''' read in the parameters for the NMF and burst FSPS emulators that
+        are split into wavelength bins (see `_read_emulator`) 
+        '''
+        # load NMF emulator 
+        self._nmf_emu_params, self._nmf_emu_waves = self._read_emulator('nmf')
+        self._nmf_n_emu = len(self._nmf_emu_params.pca_transform)
 
         # load burst emulator
-        f_nn = lambda npca, i: 'burst.v0.1.seed0_199.w%s.pca%i.6x512.nbatch250.pkl' % (wbins[i], npca)
-        self._burst_n_emu = len(npcas)
-        self._burst_emu_params    = [] 
-        self._burst_emu_wave      = [] 
+        self._burst_emu_params, self._burst_emu_waves = self._read_emulator('burst')
+        self._burst_n_emu = len(self._burst_emu_params.pca_transform)
 
-        for i, npca in enumerate(npcas): 
-            fpkl = open(os.path.join(
-                os.path.dirname(os.path.realpath(__file__)), 'dat', 
-                f_nn(npca, i)), 'rb')
-            params = pickle.load(fpkl)
+        # precompute the rest-frame log-wavelength grid and rebinning matrix
+        # used to apply velocity dispersion 
+        self._vdisp_grid(self._nmf_emu_waves)
 
-            self._burst_emu_params.append(params)
-            self._burst_emu_wave.append(params[13])
+        # L2 cache size for tiling the emulator batches 
+        self._l2_bytes = UT.cache_size(level=2) 
 
-        self._burst_emu_waves = np.concatenate(self._burst_emu_wave) 
+        # compile (or load the cached) emulator forward pass now so that it
+        # is not billed to the first SED evaluation
+        for emu_params in [self._nmf_emu_params, self._burst_emu_params]: 
+            self._emu_nn(np.ones(emu_params.param_shift.shape[-1]), emu_params)
         return None 
 
     def SFH(self, tt, zred=None, tage=None, _burst=True): 
@@ -618,60 +911,117 @@ class NMF(Model):
             raise ValueError("specify either the redshift or age of the galaxy")
         if tage is None: 
             assert isinstance(zred, float)
-            tage = self.cosmo.age(zred).value # age in Gyr
+            tage = self._tage_z(zred) # age in Gyr
 
         theta = self._parse_theta(tt) 
 
         # sfh nmf basis coefficients 
-        tt_sfh = np.array([theta['beta1_sfh'], theta['beta2_sfh'],
-            theta['beta3_sfh'], theta['beta4_sfh']]).T
+        tt_sfh = np.array([theta.beta1_sfh, theta.beta2_sfh,
+            theta.beta3_sfh, theta.beta4_sfh]).T
     
         # log-spaced lookback time bin edges 
         tlb_edges = UT.tlookback_bin_edges(tage)
 
-        sfh_basis_tlb = np.array([
-            UT.trapz_rebin(self._t_lb_hr, _sfh_basis, edges=tlb_edges) 
-            for _sfh_basis in self._sfh_basis_hr])
+        sfh_basis_tlb, _ = self._bases_tlb(tage)
 
-        sfh = np.sum(np.array([tt_sfh[:,i][:,None] *
-            sfh_basis_tlb[i][None,:] for i in range(self._N_nmf_sfh)]),
-            axis=0)
+        mstar = 10**theta.logmstar # stellar mass 
 
-        sfh /= np.sum(1e9 * np.diff(tlb_edges) * sfh, axis=1)[:,None] # normalize 
-      
-        # add starburst 
-        if self._burst and _burst: 
-            fburst = theta['fburst'] # fraction of stellar mass from star burst
-            tburst = theta['tburst'] # time of star burst
-       
-            noburst = (tburst > tage)
-            fburst[noburst] = 0. 
+        # normalization of the SFH to the stellar mass. The SFH is linear in
+        # the bases, so its integral is the linear combination of the
+        # integrals of the bases 
+        norm = mstar / (1e9 * (tt_sfh @ (sfh_basis_tlb @ np.diff(tlb_edges))))
 
-            # add normalized starburst to SFH 
-            sfh *= (1. - fburst)[:,None] 
-            sfh += fburst[:,None] * self._SFH_burst(tburst, tlb_edges)
+        burst = (self._burst and _burst)
+        if burst: 
+            fburst = theta.fburst # fraction of stellar mass from star burst
+            tburst = theta.tburst # time of star burst
+       
+            # no burst if it's outside the age of the galaxy 
+            fburst = np.where(tburst > tage, 0., fburst) 
+            norm = norm * (1. - fburst)
 
-        # multiply by stellar mass 
-        sfh *= 10**theta['logmstar'][:,None]
+        # the scalings are applied to the coefficients so that the SFH is
+        # only computed in a single pass 
+        sfh = (tt_sfh * norm[:,None]) @ sfh_basis_tlb
+      
+        # add normalized starburst to SFH 
+        if burst: 
+            self._SFH_burst(tburst, tlb_edges, weight=fburst * mstar, out=sfh)
 
         if np.atleast_2d(tt).shape[0] == 1: 
             return tlb_edges, sfh[0]
         return tlb_edges, sfh 
 
-    def _SFH_burst(self, tburst, tedges): 
-        ''' place a single star-burst event on the SFH
+    def _sfh_basis_rebin(self, tedges): 
+        ''' SFH NMF bases trapezoidal rebinned (see `UT.trapz_rebin`) from
+        the high resolution lookback time grid onto bin edges `tedges`. The
+        integral over each bin is the difference of the cumulative integral
+        of the tabulated bases, which is precomputed, at the bin edges. This
+        is O(number of bins) rather than O(number of hi-res time steps). 
+        Like `UT.trapz_rebin`, the bin edges have to be within the hi-res
+        lookback time grid. 
+        '''
+        t = self._t_lb_hr 
+        if tedges[0] < t[0] or t[-1] < tedges[-1]:
+            raise ValueError('edges must be within input x range')
+
+        # interval of the hi-res grid that each edge falls in 
+        j = np.clip(np.searchsorted(t, tedges, side='right') - 1, 0, len(t) - 2)
+        dt = tedges - t[j]
+
+        # cumulative integral of the linearly interpolated bases at the edges
+        y_j = self._sfh_basis_hr[:,j]
+        y_edge = y_j + dt * (self._sfh_basis_hr[:,j+1] - y_j) / (t[j+1] - t[j])
+        cum_edge = self._sfh_basis_hr_cum[:,j] + 0.5 * dt * (y_j + y_edge)
+
+        return np.diff(cum_edge, axis=1) / np.diff(tedges)
+
+    def _eval_sfh_basis(self, tlb): 
+        ''' SFH NMF bases linearly interpolated to lookback times `tlb`
+        stacked into a [N_nmf_sfh, len(tlb)] array 
+        '''
+        return UT.interp_linear(tlb, self._nmf_t_lb_sfh, self._nmf_sfh_basis)
+
+    def _zh_basis_eval(self, tlb): 
+        ''' ZH NMF bases linearly interpolated to lookback times `tlb`
+        stacked into a [N_nmf_zh, len(tlb)] array 
+        '''
+        return UT.interp_linear(tlb, self._nmf_t_lb_zh, self._nmf_zh_basis)
+
+    def _bases_tlb(self, tage): 
+        ''' SFH bases rebinned onto the log-spaced lookback time bins of a
+        galaxy of age `tage` and ZH bases evaluated at the bin centers. The
+        bins only depend on `tage`, so both are computed at first use and
+        cached for each tage. 
+        '''
+        key = float(tage) 
+        bases = self._tlb_bases.get(key) 
+        if bases is None: 
+            tlb_edges = UT.tlookback_bin_edges(tage)
+            tlb = 0.5 * (tlb_edges[1:] + tlb_edges[:-1])
+
+            bases = (self._sfh_basis_rebin(tlb_edges), self._zh_basis_eval(tlb))
+            for basis in bases: basis.setflags(write=False) 
+            if len(self._tlb_bases) >= 256: self._tlb_bases.clear() 
+            self._tlb_bases[key] = bases
+        return bases 
+
+    def _SFH_burst(self, tburst, tedges, weight=1., out=None): 
+        ''' place a single star-burst event, which forms `weight` Msun, on
+        the SFH. If `out` is specified, the burst is added to it. 
         '''
         tburst = np.atleast_1d(tburst)
+        weight = np.broadcast_to(weight, tburst.shape)
         dts = np.diff(tedges)
         
         # burst within the age of the galaxy 
-        has_burst = (tburst < tedges.max()) 
+        has_burst = np.flatnonzero(tburst < tedges.max()) 
         
         # log-spaced lookback time bin with burst 
         iburst = np.digitize(tburst[has_burst], tedges)-1
 
-        sfh = np.zeros((len(tburst), len(tedges)-1))
-        sfh[has_burst, iburst] += 1. / (1e9 * dts[iburst])
+        sfh = np.zeros((len(tburst), len(tedges)-1)) if out is None else out 
+        np.add.at(sfh, (has_burst, iburst), weight[has_burst] / (1e9 * dts[iburst]))
         return sfh 
    
     def avgSFR(self, tt, zred=None, tage=None, dt=1):
@@ -699,49 +1049,61 @@ class NMF(Model):
             raise ValueError('specify either zred or tage')
         if tage is None: 
             assert isinstance(zred, float)
-            tage = self.cosmo.age(zred).value # age in Gyr
+            tage = self._tage_z(zred) # age in Gyr
 
         theta = self._parse_theta(tt) 
 
         # sfh nmf basis coefficients 
-        tt_sfh = np.array([theta['beta1_sfh'], theta['beta2_sfh'],
-            theta['beta3_sfh'], theta['beta4_sfh']]).T
+        tt_sfh = np.array([theta.beta1_sfh, theta.beta2_sfh,
+            theta.beta3_sfh, theta.beta4_sfh]).T
     
-        # log-spaced lookback time bin edges 
-        tlb_edges = UT.tlookback_bin_edges(tage)
-        assert dt < tlb_edges[-1]
-
-        sfh_basis_tlb = np.array([
-            UT.trapz_rebin(self._t_lb_hr, _sfh_basis, edges=tlb_edges) 
-            for _sfh_basis in self._sfh_basis_hr])
-
-        sfh = np.sum(np.array([tt_sfh[:,i][:,None] *
-            sfh_basis_tlb[i][None,:] for i in range(self._N_nmf_sfh)]),
-            axis=0)
-
-        sfh /= np.sum(np.diff(tlb_edges) * sfh, axis=1)[:,None] # normalize 
-        
-        # calculate stellar mass formed over 0-dt 
-        i_dt = np.digitize(dt, tlb_edges) - 1
-        Mform = np.sum(np.diff(tlb_edges)[:i_dt][None,:] * sfh[:,:i_dt], axis=1) 
-        Mform += (dt - tlb_edges[i_dt]) * sfh[:,i_dt]
+        # fraction of stellar mass formed over 0-dt by the normalized SFH. 
+        # This is linear in the SFH, so it reduces to weights on the SFH
+        # bases 
+        w_dt, w_norm = self._avgSFR_weights(tage, dt) 
+        Mform = (tt_sfh @ w_dt) / (tt_sfh @ w_norm) 
         
         # add starburst event 
         if self._burst: 
-            fburst = theta['fburst'] # fraction of stellar mass from star burst
-            tburst = theta['tburst'] # time of star burst
+            fburst = theta.fburst # fraction of stellar mass from star burst
+            tburst = theta.tburst # time of star burst
        
-            noburst = (tburst > tage)
-            fburst[noburst] = 0. 
+            # no burst if it's outside the age of the galaxy 
+            fburst = np.where(tburst > tage, 0., fburst) 
             Mform *= (1. - fburst)
             
             burst_dt = (tburst < dt)
-            Mform[burst_dt] += theta['fburst'][burst_dt]
+            Mform[burst_dt] += fburst[burst_dt]
 
         # multiply by stellar mass 
-        avg_sfr = Mform *  10**theta['logmstar'] / dt / 1e9
+        avg_sfr = Mform *  10**theta.logmstar / dt / 1e9
         return avg_sfr
 
+    def _avgSFR_weights(self, tage, dt): 
+        ''' weights of the SFH bases for the stellar mass formed over the
+        past `dt` Gyr (`w_dt`) and the total stellar mass formed (`w_norm`)
+        in the log-spaced lookback time bins for a galaxy of age `tage`.
+        The weights are cached for each (tage, dt). 
+        '''
+        key = (float(tage), float(dt)) 
+        weights = self._avgsfr_weights.get(key)
+        if weights is None: 
+            # log-spaced lookback time bin edges 
+            tlb_edges = UT.tlookback_bin_edges(tage)
+            assert dt < tlb_edges[-1]
+
+            sfh_basis_tlb, _ = self._bases_tlb(tage)
+            dts = np.diff(tlb_edges) # bin widths
+            
+            # stellar mass formed over 0-dt: full bins + part of the bin
+            # containing dt
+            w = np.clip(dt - tlb_edges[:-1], 0., dts)
+
+            weights = (sfh_basis_tlb @ w, sfh_basis_tlb @ dts)
+            if len(self._avgsfr_weights) >= 256: self._avgsfr_weights.clear() 
+            self._avgsfr_weights[key] = weights
+        return weights 
+
     def ZH(self, tt, zred=None, tage=None): 
         ''' metallicity history for given set of parameters. metallicity is
         parameterized using a 2 component NMF basis. The parameter values
@@ -768,22 +1130,18 @@ class NMF(Model):
             raise ValueError("specify either the redshift or age of the galaxy")
         if tage is None: 
             assert isinstance(zred, float)
-            tage = self.cosmo.age(zred).value # age in Gyr
+            tage = self._tage_z(zred) # age in Gyr
         theta = self._parse_theta(tt) 
 
         # metallicity history basis coefficients  
-        tt_zh = np.array([theta['gamma1_zh'], theta['gamma2_zh']]).T
+        tt_zh = np.array([theta.gamma1_zh, theta.gamma2_zh]).T
 
         # log-spaced lookback time bin edges 
         tlb_edges = UT.tlookback_bin_edges(tage)
-        tlb = 0.5 * (tlb_edges[1:] + tlb_edges[:-1])
-
-        # metallicity basis
-        _z_basis = np.array([self._zh_basis[i](tlb) for i in range(self._N_nmf_zh)]) 
 
         # get metallicity history
-        zh = np.sum(np.array([tt_zh[:,i][:,None] * _z_basis[i][None,:] for i in
-            range(self._N_nmf_zh)]), axis=0).clip(self._Z_min, self._Z_max) 
+        _, zh_basis_tlb = self._bases_tlb(tage)
+        zh = (tt_zh @ zh_basis_tlb).clip(self._Z_min, self._Z_max) 
 
         if tt_zh.shape[0] == 1: return tlb_edges, zh[0]
         return tlb_edges, zh 
@@ -802,7 +1160,7 @@ class NMF(Model):
         _, zh = self.ZH(tt, tage=tage, zred=zred) 
 
         # mass weighted average
-        z_mw = np.sum(1e9 * np.diff(tlb_edge)[None,:] * sfh * zh, axis=1) / (10**theta['logmstar']) 
+        z_mw = np.sum(1e9 * np.diff(tlb_edge)[None,:] * sfh * zh, axis=1) / (10**theta.logmstar) 
         return z_mw 
 
     def tage_MW(self, tt, tage=None, zred=None):
@@ -818,9 +1176,34 @@ class NMF(Model):
         th = 0.5 * (tlb_edge[1:] + tlb_edge[:-1]) 
 
         # mass weighted average
-        t_mw = np.sum(1e9 * np.diff(tlb_edge)[None,:] * sfh * th, axis=1) / (10**theta['logmstar']) 
+        t_mw = np.sum(1e9 * np.diff(tlb_edge)[None,:] * sfh * th, axis=1) / (10**theta.logmstar) 
         return t_mw 
 
+    @staticmethod
+    def _load_basis(ftxt): 
+        ''' read in the ASCII table `ftxt`. np.loadtxt is slow, so the table
+        is saved as a binary .npy file next to it the first time it is read
+        and the (memory-mapped) .npy file is read from then on. The .npy file
+        is regenerated if the ASCII table has been modified since it was
+        written. If the .npy file cannot be written (e.g. read-only
+        installation) the ASCII table is read every time. 
+        '''
+        fnpy = ftxt + '.npy'
+        if os.path.isfile(fnpy) and os.path.getmtime(fnpy) >= os.path.getmtime(ftxt): 
+            return np.load(fnpy, mmap_mode='r')
+
+        arr = np.loadtxt(ftxt)
+        try: 
+            # write to a temporary file and rename it, so that other
+            # processes never read a partially written file 
+            ftmp = '%s.%i' % (fnpy, os.getpid())
+            with open(ftmp, 'wb') as _ftmp: 
+                np.save(_ftmp, arr)
+            os.replace(ftmp, fnpy)
+        except OSError: 
+            pass 
+        return arr 
+
     def _load_NMF_bases(self, name='tojeiro.4comp'): 
         ''' read in NMF SFH and ZH bases. These bases are used to reduce the
         dimensionality of the SFH and ZH. 
@@ -831,14 +1214,14 @@ class NMF(Model):
             fzh = os.path.join(dir_dat, 'NMF_2basis_Z_components_nowgt_lin_Nc2.txt') 
             ft = os.path.join(dir_dat, 'sfh_t_int.txt') 
 
-            nmf_sfh = np.loadtxt(fsfh)[:,::-1] # basis order is jumbled up it should be [2 ,0, 1, 3]
-            nmf_zh  = np.loadtxt(fzh)[:,::-1] 
-            nmf_t   = np.loadtxt(ft)[::-1] # look back time 
+            nmf_sfh = self._load_basis(fsfh)[:,::-1] # basis order is jumbled up it should be [2 ,0, 1, 3]
+            nmf_zh  = self._load_basis(fzh)[:,::-1] 
+            nmf_t   = self._load_basis(ft)[::-1] # look back time 
 
-            self._nmf_t_lb_sfh      = nmf_t 
-            self._nmf_t_lb_zh       = nmf_t 
-            self._nmf_sfh_basis     = np.array([nmf_sfh[2], nmf_sfh[0], nmf_sfh[1], nmf_sfh[3]])
-            self._nmf_zh_basis      = nmf_zh
+            self._nmf_t_lb_sfh      = np.ascontiguousarray(nmf_t)
+            self._nmf_t_lb_zh       = self._nmf_t_lb_sfh
+            self._nmf_sfh_basis     = nmf_sfh[[2, 0, 1, 3]]
+            self._nmf_zh_basis      = np.ascontiguousarray(nmf_zh)
         elif name in ['tng.4comp', 'tng.6comp']: 
             icomp = int(name.split('.')[-1][0])
             fsfh = os.path.join(dir_dat, 'NMF_basis.sfh.tng%icomp.txt' % icomp) 
@@ -846,37 +1229,32 @@ class NMF(Model):
             ftsfh = os.path.join(dir_dat, 't_sfh.tng%icomp.txt' % icomp) 
             ftzh = os.path.join(dir_dat, 'sfh_t_int.txt') 
 
-            nmf_sfh     = np.loadtxt(fsfh, unpack=True) 
-            nmf_zh      = np.loadtxt(fzh) 
-            nmf_tsfh    = np.loadtxt(ftsfh) # look back time 
-            nmf_tzh     = np.loadtxt(ftzh) # look back time 
+            nmf_sfh     = self._load_basis(fsfh).T
+            nmf_zh      = self._load_basis(fzh) 
+            nmf_tsfh    = self._load_basis(ftsfh) # look back time 
+            nmf_tzh     = self._load_basis(ftzh) # look back time 
 
-            self._nmf_t_lb_sfh      = nmf_tsfh
-            self._nmf_t_lb_zh       = nmf_tzh[::-1]
-            self._nmf_sfh_basis     = nmf_sfh 
-            self._nmf_zh_basis      = nmf_zh[:,::-1]
+            self._nmf_t_lb_sfh      = np.ascontiguousarray(nmf_tsfh)
+            self._nmf_t_lb_zh       = np.ascontiguousarray(nmf_tzh[::-1])
+            self._nmf_sfh_basis     = np.ascontiguousarray(nmf_sfh)
+            self._nmf_zh_basis      = np.ascontiguousarray(nmf_zh[:,::-1])
         else:
             raise NotImplementedError
 
         self._Ncomp_sfh = self._nmf_sfh_basis.shape[0]
         self._Ncomp_zh = self._nmf_zh_basis.shape[0]
         
-        # SFH bases as a function of lookback time 
-        self._sfh_basis = [
-                Interp.InterpolatedUnivariateSpline(
-                    self._nmf_t_lb_sfh, 
-                    self._nmf_sfh_basis[i], k=1) 
-                for i in range(self._Ncomp_sfh)
-                ]
-        self._zh_basis = [
-                Interp.InterpolatedUnivariateSpline(
-                    self._nmf_t_lb_zh, 
-                    self._nmf_zh_basis[i], k=1) 
-                for i in range(self._Ncomp_zh)]
-        
         # high resolution tabulated SFHs used in the SFH calculation
-        self._t_lb_hr       = np.linspace(0., 13.8, int(5e4))
-        self._sfh_basis_hr  = [sfh_basis(self._t_lb_hr) for sfh_basis in self._sfh_basis]
+        self._t_lb_hr       = np.linspace(0., 13.8, int(self._n_thr))
+        sfh_basis_hr        = self._eval_sfh_basis(self._t_lb_hr)
+        # and their cumulative trapezoidal integral for rebinning, which is
+        # accumulated and kept in double precision. The tabulated SFHs are
+        # only used to interpolate within a single hi-res time step, so
+        # single precision is plenty 
+        self._sfh_basis_hr_cum = np.zeros(sfh_basis_hr.shape) 
+        self._sfh_basis_hr_cum[:,1:] = np.cumsum(0.5 * np.diff(self._t_lb_hr) * 
+                (sfh_basis_hr[:,1:] + sfh_basis_hr[:,:-1]), axis=1)
+        self._sfh_basis_hr  = np.ascontiguousarray(sfh_basis_hr, dtype=np.float32)
         return None 
 
     def _init_model(self, **kwargs): 
@@ -919,20 +1297,35 @@ class NMF(Model):
             self._sps_model = self._fsps 
         else: 
             self._sps_model = self._emu
+            self._sps_model_batch = self._emu
             self._load_emulator()
 
         return None 
 
     def _ssp_initiate(self): 
         ''' initialize sps (FSPS StellarPopulaiton object) 
+
+        Notes
+        -----
+        * StellarPopulation objects are expensive to construct, so one is
+        cached at module level for each configuration and shared by all the
+        models in the process. Its params are stateful: `_fsps` and
+        `_fsps_burst` set every param they depend on before each spectrum. 
         '''
         sfh         = 0 # tabulated SFH
         dust_type   = 4 # dust1, dust2, and dust_index 
         imf_type    = 1 # chabrier
-
-        self._ssp = fsps.StellarPopulation(
-                zcontinuous=1,          # interpolate metallicities
-                sfh=sfh,                # sfh type 
-                dust_type=dust_type,            
-                imf_type=imf_type)             # chabrier 
+        zcontinuous = 1 # interpolate metallicities
+
+        key = (sfh, dust_type, imf_type, zcontinuous) 
+        if key not in _fsps_ssps: 
+            _fsps_ssps[key] = fsps.StellarPopulation(
+                    zcontinuous=zcontinuous,
+                    sfh=sfh,                # sfh type 
+                    dust_type=dust_type,            
+                    imf_type=imf_type)      # chabrier 
+        self._ssp = _fsps_ssps[key]
+
+        # buffer for adding up the SSP spectra in `_fsps` 
+        self._lum_ssp_buf = np.zeros(len(self._ssp.wavelengths))
         return None  
@@ -48,6 +48,35 @@ def tlookback_bin_edges(tage):
     else: 
         return np.concatenate([bin_edges[bin_edges < tage], [tage]])
 
+def interp_linear(x, xp, fp): 
+    ''' piecewise linear interpolation of each row of `fp`, tabulated at the
+    increasing `xp`, at `x`. Unlike np.interp, values outside of `xp` are
+    linearly extrapolated from the first and last intervals, the same as
+    `scipy.interpolate.InterpolatedUnivariateSpline(xp, fp[i], k=1)`. 
+
+    parameters
+    ----------
+    x : float or array_like[Nx,]
+        points to evaluate at 
+
+    xp : array_like[Np,]
+        increasing points where `fp` is tabulated
+
+    fp : array_like[..., Np]
+        tabulated values 
+
+    Returns
+    -------
+    f : array_like[..., Nx] 
+    '''
+    x = np.asarray(x) 
+    # interval of xp that each x falls in (or the first/last interval) 
+    j = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+    w = (x - xp[j]) / (xp[j+1] - xp[j])
+
+    f_j = fp[...,j]
+    return f_j + w * (fp[...,j+1] - f_j)
+
 # --- the code below is taken from the `desispec` and `redrock` python package.
 # I've copied the code over instead of importing it to reduce package
 # dependencies.
@@ -253,6 +282,209 @@ def trapz_rebin(x, y, xnew=None, edges=None):
     return result
 
 
+@numba.jit
+def _trapz_rebin_weights(x, edges, rows, cols, vals):
+    '''
+    Numba-friendly weights of trapezoidal rebinning. The rebinned y is a
+    linear function of y: over the part [a, b] of input interval [x[k],
+    x[k+1]] that overlaps with bin i, the integral of the linearly
+    interpolated y is
+        0.5 * (b-a) * ((x[k+1]-a) + (x[k+1]-b)) / (x[k+1]-x[k]) * y[k] +
+        0.5 * (b-a) * ((a-x[k]) + (b-x[k])) / (x[k+1]-x[k]) * y[k+1]
+    `rows`, `cols`, and `vals` are pre-allocated arrays for the (unsummed)
+    sparse matrix entries. Returns the number of entries.
+    '''
+    nbin = len(edges) - 1
+    j = 0  #- index counter for inputs
+    n = 0  #- index counter for matrix entries
+
+    for i in range(nbin):
+        width = edges[i+1] - edges[i]
+
+        #- Seek the first input interval that overlaps with the bin
+        while x[j+1] <= edges[i]:
+            j += 1
+
+        k = j
+        while k < len(x) - 1 and x[k] < edges[i+1]:
+            a = max(edges[i], x[k])
+            b = min(edges[i+1], x[k+1])
+            w = 0.5 * (b - a) / (x[k+1] - x[k]) / width
+
+            rows[n] = i
+            cols[n] = k
+            vals[n] = w * ((x[k+1] - a) + (x[k+1] - b))
+            n += 1
+
+            rows[n] = i
+            cols[n] = k + 1
+            vals[n] = w * ((a - x[k]) + (b - x[k]))
+            n += 1
+
+            k += 1
+
+    return n
+
+def build_trapz_rebin_matrix(x, xnew=None, edges=None):
+    """Sparse matrix R of trapezoidal rebinning, such that R.dot(y) is
+    trapz_rebin(x, y, xnew=xnew, edges=edges). For a fixed pair of input and
+    output grids, this is much cheaper than calling trapz_rebin repeatedly
+    and can be applied to many spectra at once.
+    Args:
+        x (array): input x values.
+        xnew (array): (optional) new bin centers.
+        edges (array): (optional) new bin edges.
+    Returns:
+        scipy.sparse.csr_matrix: [len(edges)-1, len(x)] rebinning matrix
+    Raises:
+        ValueError: if edges are outside the range of x
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if edges is None:
+        edges = centers2edges(xnew)
+    else:
+        edges = np.asarray(edges, dtype=np.float64)
+
+    if edges[0] < x[0] or x[-1] < edges[-1]:
+        raise ValueError('edges must be within input x range')
+
+    #- each bin overlaps with at most (number of input samples in the bin + 1)
+    #- input intervals, each contributing 2 entries
+    nmax = 2 * (len(edges) + len(x))
+    rows = np.empty(nmax, dtype=np.int64)
+    cols = np.empty(nmax, dtype=np.int64)
+    vals = np.empty(nmax, dtype=np.float64)
+
+    n = _trapz_rebin_weights(x, edges, rows, cols, vals)
+
+    return scipy.sparse.csr_matrix((vals[:n], (rows[:n], cols[:n])),
+            shape=(len(edges)-1, len(x)))
+
+
+def cache_size(level=2, default=2**20):
+    """Size of the CPU cache of given level in bytes. Read from sysfs on
+    Linux; `default` is returned if it is not available.
+    """
+    for index in range(8):
+        fcache = '/sys/devices/system/cpu/cpu0/cache/index%i/' % index
+        try:
+            with open(fcache + 'level') as f:
+                if int(f.read()) != level: continue
+            with open(fcache + 'type') as f:
+                if f.read().strip() == 'Instruction': continue
+            with open(fcache + 'size') as f:
+                size = f.read().strip()
+        except (OSError, ValueError):
+            break
+        units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+        if size[-1] in units:
+            return int(size[:-1]) * units[size[-1]]
+        return int(size)
+    return default
+
+
+# the emulator activation is evaluated with fast math, but without the
+# `nnan`/`ninf` flags. 
+_emu_fastmath = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+
+@numba.njit(cache=True, fastmath=_emu_fastmath)
+def _emu_activation(act, b, alphas, betas):
+    ''' in-place fused bias and activation function of the emulator hidden
+    layers: act = (betas + (1 - betas) / (1 + exp(-alphas * (act + b)))) * (act + b)
+    for float32 `act`.
+
+    exp() is a libm call that LLVM does not vectorize, so it is replaced by
+    the Cephes expf range reduction and polynomial (~1 ulp in float32), with
+    2^k constructed from its bits. All loops then compile to SIMD
+    instructions. The exponent is clipped to [-87, 88], where exp() is
+    within the normal float32 range, which saturates the sigmoid the same
+    way overflow does. 
+    '''
+    f = np.float32
+    nh = act.shape[1]
+    expr = np.empty(nh, dtype=np.float32)   #- exp(r)
+    bits = np.empty(nh, dtype=np.int32)     #- bits of 2^k
+    twok = bits.view(np.float32)
+
+    for n in range(act.shape[0]):
+        for j in range(nh):
+            a = act[n,j] + b[j]
+            act[n,j] = a
+
+            #- exp(x) = 2^k exp(r) with |r| <= ln(2)/2
+            x = min(max(-alphas[j] * a, f(-87.)), f(88.))
+            k = np.floor(x * f(1.44269504088896341) + f(0.5))
+            r = x - k * f(0.693359375) - k * f(-2.12194440e-4)
+
+            p = f(1.9875691500e-4)
+            p = p * r + f(1.3981999507e-3)
+            p = p * r + f(8.3334519073e-3)
+            p = p * r + f(4.1665795894e-2)
+            p = p * r + f(1.6666665459e-1)
+            p = p * r + f(5.0000001201e-1)
+            expr[j] = p * r * r + r + f(1.)
+            bits[j] = (np.int32(k) + 127) << 23
+
+        for j in range(nh):
+            act[n,j] = (betas[j] + (f(1.) - betas[j]) / (f(1.) + expr[j] * twok[j])) * act[n,j]
+    return
+
+
+@numba.njit(cache=True, fastmath=_emu_fastmath)
+def emu_forward(tt, param_shift, param_scale, W_in, b_in, W_hid, b_hid,
+        alphas, betas, W_out, b_out, pca_shift, pca_scale, pca_transform,
+        spec_shift, spec_scale, wave_index):
+    ''' forward pass of a PCA neural network emulator (Alsing+2020) that is
+    split into Nbin wavelength bins. The parameters of all wavelength bins
+    are stacked into arrays (hidden layers of the same width into 4D arrays)
+    so that the whole emulator is evaluated in a single compiled call. The
+    number of PCA components of each bin is zero-padded to Npca. 
+
+    Args:
+        tt (array): [N, Nin] input parameters
+        param_shift, param_scale (array): [Nbin, Nin] input normalization
+        W_in, b_in (array): [Nbin, Nin, Nh], [Nbin, Nh] first layer
+        W_hid, b_hid (array): [Nbin, Nlayer-2, Nh, Nh], [Nbin, Nlayer-2, Nh]
+            hidden layers
+        alphas, betas (array): [Nbin, Nlayer-1, Nh] activation function
+            parameters
+        W_out, b_out (array): [Nbin, Nh, Npca], [Nbin, Npca] final (linear)
+            layer
+        pca_shift, pca_scale (array): [Nbin, Npca] PCA coefficient
+            normalization
+        pca_transform (tuple): Nbin [Npca, Nwave_i] PCA bases
+        spec_shift, spec_scale (array): [Nwave] spectrum normalization
+        wave_index (array): [Nbin+1] index of the first wavelength of each bin
+    Returns:
+        array: [N, Nwave] emulator output
+    '''
+    spec = np.empty((tt.shape[0], wave_index[-1]))
+
+    for ib in range(W_in.shape[0]):
+        layer = (tt - param_shift[ib]) / param_scale[ib]
+
+        act = np.dot(layer, W_in[ib])
+        _emu_activation(act, b_in[ib], alphas[ib,0], betas[ib,0])
+        for i in range(W_hid.shape[1]):
+            act = np.dot(act, W_hid[ib,i])
+            _emu_activation(act, b_hid[ib,i], alphas[ib,i+1], betas[ib,i+1])
+
+        # final (linear) layer -> rescaled PCA coefficients
+        pca = np.dot(act, W_out[ib])
+        for n in range(pca.shape[0]):
+            for j in range(pca.shape[1]):
+                pca[n,j] = (pca[n,j] + b_out[ib,j]) * pca_scale[ib,j] + pca_shift[ib,j]
+
+        # multiply out PCA basis and shift and re-scale spectrum
+        _spec = np.dot(pca, pca_transform[ib])
+        i0 = wave_index[ib]
+        for n in range(_spec.shape[0]):
+            for j in range(_spec.shape[1]):
+                spec[n,i0+j] = _spec[n,j] * spec_scale[i0+j] + spec_shift[i0+j]
+    return spec
+
+
 def betterstep(bins, y, **kwargs):
     """A 'better' version of matplotlib's step function 
     (from https://gist.github.com/dfm/e9d36037e363f04acbc668ec7c408237)
@@ -0,0 +1,62 @@
+'''
+
+tests for provabgs.models
+
+
+'''
+import os
+import numpy as np
+import pytest
+
+from provabgs import models as Models
+
+
+dir_dat = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+
+
+@pytest.fixture(scope='module')
+def nmf():
+    return Models.NMF(burst=True, emulator=True)
+
+
+@pytest.mark.parametrize('vdisp, rtol', [(0., 1e-5), (1e-4, 2e-4), (30., 5e-5), (150., 1e-5)])
+def test_sed_vdisp(nmf, vdisp, rtol):
+    ''' compare the SEDs with velocity dispersion against reference fluxes
+    computed with the original implementation, which smoothed the spectra on
+    a log-wavelength grid in the observed frame. Velocity dispersion is now
+    applied on a rest-frame log-wavelength grid, so the fluxes differ by the
+    resampling onto a different log-wavelength grid. `rtol` is relative to the
+    maximum flux of each spectrum.
+    '''
+    ref = np.load(os.path.join(dir_dat, 'sed_vdisp_ref.npz'))
+    flux_ref = ref['flux_vdisp%g' % vdisp]
+
+    _, flux = nmf.sed(ref['theta'], np.repeat(0.2, len(ref['theta'])),
+            vdisp=vdisp, wavelength=ref['wave'])
+
+    err = np.abs(flux - flux_ref).max(axis=1) / np.abs(flux_ref).max(axis=1)
+    assert np.all(err < rtol)
+
+
+@pytest.mark.parametrize('tage', [0.05, 2., 9.5, 13.8])
+def test_sfh_basis_rebin(nmf, tage):
+    ''' the SFH bases rebinned onto the lookback time bins using the
+    cumulative integral should reproduce trapezoidal rebinning of the hi-res
+    tabulated bases with `UT.trapz_rebin`
+    '''
+    tedges = Models.UT.tlookback_bin_edges(tage)
+    sfh_basis_hr = nmf._eval_sfh_basis(nmf._t_lb_hr)
+
+    sfh_basis_ref = np.array([Models.UT.trapz_rebin(nmf._t_lb_hr, basis,
+        edges=tedges) for basis in sfh_basis_hr])
+
+    assert np.allclose(nmf._sfh_basis_rebin(tedges), sfh_basis_ref,
+            rtol=1e-6, atol=1e-6 * np.abs(sfh_basis_ref).max())
+
+
+def test_sfh_basis_rebin_range(nmf):
+    ''' bin edges outside of the hi-res lookback time grid raise an error, as
+    in `UT.trapz_rebin`
+    '''
+    with pytest.raises(ValueError):
+        nmf._sfh_basis_rebin(Models.UT.tlookback_bin_edges(14.))